@@ -0,0 +1,77 @@
+"""
+Image augmentation, applied either per image in the data loader workers or
+to whole collated batches of images.
+"""
+import math
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as tvt
+
+
+def get_messidor_img_transform(config, img_size=512, train=True):
+    """Return the transform applied to each PIL image in the data loader
+    workers.
+
+    If config.batch_augmentation, the workers only resize and crop each image
+    to a uint8 tensor, and the random augmentation is applied later to the
+    collated batch by a BatchAugmentation.
+
+    If not train, return a deterministic transform without augmentation.
+    """
+    if config.batch_augmentation or not train:
+        return tvt.Compose([
+            tvt.Resize(img_size),
+            tvt.CenterCrop(img_size),
+            tvt.PILToTensor() if config.batch_augmentation
+            else tvt.ToTensor(),
+        ])
+    return tvt.Compose([
+        tvt.RandomRotation(degrees=15),
+        tvt.RandomResizedCrop(
+            img_size, scale=(0.9, 1.0), ratio=(1, 1)),
+        tvt.RandomHorizontalFlip(),
+        #  tvt.RandomVerticalFlip(),
+        tvt.ToTensor(),
+    ])
+
+
+class BatchAugmentation:
+    """Randomly rotate, zoom into and horizontally flip a batch of images
+    using one affine grid sample for the whole batch.  Each image gets its own
+    random parameters.  This approximates the per image RandomRotation,
+    RandomResizedCrop and RandomHorizontalFlip transforms, but runs as a few
+    tensor ops, so it uses the intra-op thread pool (or the gpu).
+
+        >>> augment = BatchAugmentation(degrees=15, scale=(0.9, 1.0))
+        >>> X = augment(X)  # X is a (B, C, H, W) uint8 or float batch
+
+    Returns a float batch with values in [0, 1] if X was uint8.
+    """
+    def __init__(self, degrees=15, scale=(0.9, 1.0), hflip_prob=0.5):
+        self.degrees = degrees
+        self.scale = scale
+        self.hflip_prob = hflip_prob
+
+    def __call__(self, X):
+        if X.dtype == torch.uint8:
+            X = X.float().div_(255)
+        B, device = X.shape[0], X.device
+
+        angle = (torch.rand(B, device=device) * 2 - 1) \
+            * math.radians(self.degrees)
+        # a crop with fraction `scale` of the image area is a zoom by
+        # sqrt(scale), and the crop can move anywhere inside the image.
+        zoom = torch.empty(B, device=device).uniform_(*self.scale).sqrt()
+        tx = (torch.rand(B, device=device) * 2 - 1) * (1 - zoom)
+        ty = (torch.rand(B, device=device) * 2 - 1) * (1 - zoom)
+        flip = 1 - 2 * (torch.rand(B, device=device) < self.hflip_prob).float()
+
+        cos, sin = angle.cos() * zoom, angle.sin() * zoom
+        theta = torch.stack([
+            torch.stack([cos * flip, -sin, tx], 1),
+            torch.stack([sin * flip, cos, ty], 1),
+        ], 1)
+        grid = F.affine_grid(theta, X.shape, align_corners=False)
+        return F.grid_sample(
+            X, grid, mode='bilinear', padding_mode='zeros',
+            align_corners=False)
@@ -0,0 +1,291 @@
+"""
+Measure throughput to choose performance settings for the current model,
+device and image size.
+
+    tune_batch_sizes(config) - batch sizes for training and for no-grad
+        validation and scoring passes.
+    plan_resources(config) - split a cpu core budget between data loader
+        workers and torch threads.
+"""
+from contextlib import contextmanager
+import copy
+import json
+import numpy as np
+import os
+from os.path import dirname, exists, join
+import platform
+import resource
+import time
+import torch
+
+from .model_configs import feedforward
+from .prefetch import get_memory_format
+
+
+def _device_name(config):
+    if config.device.startswith('cuda'):
+        return torch.cuda.get_device_name(torch.device(config.device))
+    return '%s-%scpu' % (platform.processor() or platform.machine(),
+                         os.cpu_count())
+
+
+def _is_out_of_memory(err):
+    return isinstance(err, MemoryError) or 'out of memory' in str(err)
+
+
+def _reset_peak_rss():
+    """Reset the peak resident set size of the process, if the kernel
+    supports it"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fout:
+            fout.write('5')
+    except OSError:
+        pass
+
+
+def measure_batch_size(config, batch_size, train, num_iters=3):
+    """Run the model on random images of config.cur_img_size and return
+    (imgs_per_sec, peak_memory_bytes).  Training steps run forward and
+    backward, but not the optimizer, and the caller should restore the
+    model's state afterwards.
+
+    On cuda, peak_memory_bytes is the peak allocated memory of this
+    measurement.  On cpu, it is the peak resident set size of the process.
+    It is reset before the measurement where linux allows it, otherwise it is
+    the peak so far, so measure candidates in increasing order.
+    """
+    model = config.model
+    model.train(train)
+    X = torch.rand(batch_size, 3, config.cur_img_size, config.cur_img_size,
+                   device=config.device).contiguous(
+                       memory_format=get_memory_format(model))
+    cuda = config.device.startswith('cuda')
+    if cuda:
+        torch.cuda.reset_peak_memory_stats(config.device)
+    else:
+        _reset_peak_rss()
+    for i in range(num_iters + 1):
+        if i == 1:  # don't time the first, warmup, iteration
+            if cuda:
+                torch.cuda.synchronize(config.device)
+            start = time.perf_counter()
+        if train:
+            model.zero_grad()
+            with feedforward.autocast(config):
+                yhat = model(X)
+                loss = config.lossfn(yhat, torch.zeros_like(yhat))
+            loss.backward()
+        else:
+            with torch.no_grad(), feedforward.autocast(config):
+                model(X)
+    if cuda:
+        torch.cuda.synchronize(config.device)
+    seconds = time.perf_counter() - start
+    model.zero_grad()
+    if cuda:
+        peak_memory = torch.cuda.max_memory_allocated(config.device)
+    else:  # ru_maxrss is in kilobytes on linux
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return batch_size * num_iters / seconds, peak_memory
+
+
+def _total_memory(config):
+    """Return the bytes of memory of the device: gpu memory, or the physical
+    ram of the host"""
+    if config.device.startswith('cuda'):
+        return torch.cuda.get_device_properties(
+            torch.device(config.device)).total_memory
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def best_batch_size(config, train):
+    """Return the candidate batch size with the highest throughput that fits
+    in the memory budget.  Stop at the first candidate over budget"""
+    memory_budget = config.auto_batch_size_memory_frac * _total_memory(config)
+    best, best_imgs_per_sec = None, 0
+    for batch_size in sorted(
+            int(x) for x in config.auto_batch_size_candidates.split(',')):
+        try:
+            imgs_per_sec, peak_memory = measure_batch_size(
+                config, batch_size, train)
+        except (RuntimeError, MemoryError) as err:
+            if not _is_out_of_memory(err):
+                raise
+            if config.device.startswith('cuda'):
+                torch.cuda.empty_cache()
+            break
+        print(config.log_msg_batch_size_tuning.format(
+            phase='train' if train else 'inference', **locals()))
+        if peak_memory > memory_budget:
+            break
+        if imgs_per_sec > best_imgs_per_sec:
+            best, best_imgs_per_sec = batch_size, imgs_per_sec
+    if best is None:
+        raise RuntimeError(
+            "No batch size in %s fits in memory"
+            % config.auto_batch_size_candidates)
+    return best
+
+
+@contextmanager
+def preserve_model_state(config):
+    """Restore the model's weights, BatchNorm running stats and train/eval
+    mode when the context exits"""
+    model = getattr(config.model, 'module', config.model)
+    was_training = model.training
+    state_dict = copy.deepcopy(model.state_dict())
+    try:
+        yield
+    finally:
+        model.load_state_dict(state_dict)
+        model.train(was_training)
+
+
+def tune_batch_sizes(config):
+    """Set config.batch_size, config.eval_batch_size and
+    config.scoring_batch_size to the batch sizes with the highest measured
+    throughput for training and for no-grad passes.
+
+    Results are cached per model, device, image size, memory format and
+    autocast dtype in the json file
+    config.auto_batch_size_cache, relative to config.base_dir.  Must be
+    called before the data loaders are created.
+    """
+    key = '%s|%s|%s|%s|%s' % (
+        type(config).__name__, _device_name(config), config.cur_img_size,
+        get_memory_format(config.model),
+        'bf16' if feedforward.uses_bf16_autocast(config) else 'fp32')
+    cache_fp = join(config.base_dir, config.auto_batch_size_cache) \
+        if config.auto_batch_size_cache else None
+    cache = {}
+    if cache_fp and exists(cache_fp):
+        with open(cache_fp) as fin:
+            cache = json.load(fin)
+    if key not in cache:
+        # training mode forward passes update the BatchNorm running stats
+        with preserve_model_state(config):
+            cache[key] = {
+                'train': best_batch_size(config, train=True),
+                'inference': best_batch_size(config, train=False)}
+        if cache_fp:
+            os.makedirs(dirname(cache_fp) or '.', exist_ok=True)
+            with open(cache_fp, 'w') as fout:
+                json.dump(cache, fout, indent=2, sort_keys=True)
+    config._tuned_img_size = config.cur_img_size
+    config.batch_size = cache[key]['train']
+    config.eval_batch_size = config.scoring_batch_size = \
+        cache[key]['inference']
+    print("batch sizes for %s: train %s inference %s" % (
+        key, config.batch_size, config.eval_batch_size))
+
+
+def get_cpu_cores(config):
+    """Return the ids of the cpu cores this run may use: config.cpu_budget
+    cores of the process's affinity mask, starting at index
+    config.cpu_offset, or all of them"""
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count()))
+    if config.cpu_budget:
+        if config.cpu_offset + config.cpu_budget > len(cores):
+            raise ValueError(
+                "cpu_offset %s + cpu_budget %s is more than the %s cores"
+                " this process may use" % (
+                    config.cpu_offset, config.cpu_budget, len(cores)))
+        cores = cores[config.cpu_offset:config.cpu_offset + config.cpu_budget]
+    return cores
+
+
+def set_worker_affinity(cores, worker_id):
+    """Data loader worker_init_fn.  Pin each worker to one of the cores"""
+    os.sched_setaffinity(0, {cores[worker_id % len(cores)]})
+
+
+def measure_loader(config, num_workers, num_batches):
+    """Return the images per second a data loader with num_workers workers
+    loads, not counting the first batch"""
+    idxs = np.arange(min(len(config.dataset),
+                         (num_batches + 1) * config.batch_size))
+    data_loader = feedforward.create_data_loader(
+        config, idxs, shuffle=False, num_workers=num_workers)
+    N = 0
+    for batch_idx, (X, y) in enumerate(data_loader):
+        if batch_idx == 0:
+            start = time.perf_counter()
+        else:
+            N += X.shape[0]
+    return N / (time.perf_counter() - start)
+
+
+def _split(cores, num_workers):
+    """Return (num_workers, num_threads) for a budget of len(cores) cores.
+    Loader workers and the main process's intra-op threads get their own
+    cores.  With one core, load in the main process."""
+    if len(cores) < 2:
+        return 0, 1
+    num_workers = min(max(1, num_workers), len(cores) - 1)
+    return num_workers, len(cores) - num_workers
+
+
+def calibrate_num_workers(config, cores):
+    """Return the number of loader workers that maximizes the estimated
+    throughput of the training pipeline: the min of the loader's and the
+    training step's measured images per second when the rest of the cores
+    run the intra-op threads"""
+    candidates = sorted(set(
+        _split(cores, n)[0] for n in
+        [2 ** i for i in range(len(cores).bit_length())]
+        + [len(cores) // 3]))
+    best, best_imgs_per_sec = candidates[0], 0
+    with preserve_model_state(config):
+        for num_workers in candidates:
+            _, num_threads = _split(cores, num_workers)
+            torch.set_num_threads(num_threads)
+            load_imgs_per_sec = measure_loader(
+                config, num_workers, config.resource_plan_calibration_batches)
+            train_imgs_per_sec, _ = measure_batch_size(
+                config, config.batch_size, train=True)
+            imgs_per_sec = min(load_imgs_per_sec, train_imgs_per_sec)
+            print(config.log_msg_resource_calibration.format(**locals()))
+            if imgs_per_sec > best_imgs_per_sec:
+                best, best_imgs_per_sec = num_workers, imgs_per_sec
+    return best
+
+
+def plan_resources(config):
+    """Split config.cpu_budget cores between data loader worker processes and
+    the intra-op threads of the main process, and log the split.
+
+    If config.auto_resource_plan, choose the split by a short calibration,
+    otherwise give a third of the cores to the loader workers.  Our models
+    have no inter-op parallelism, so use 1 inter-op thread.  If
+    config.worker_cpu_affinity, pin each worker to its own core and the main
+    process to the remaining cores.
+
+    If neither cpu_budget nor auto_resource_plan are set, only log the
+    current settings.  Call after tune_batch_sizes, so the calibration uses
+    the tuned batch size.
+    """
+    cores = get_cpu_cores(config)
+    if config.cpu_budget or config.auto_resource_plan:
+        if config.auto_resource_plan:
+            num_workers = calibrate_num_workers(config, cores)
+        else:
+            num_workers = len(cores) // 3
+        num_workers, num_threads = _split(cores, num_workers)
+        config.data_loader_num_workers = num_workers
+        torch.set_num_threads(num_threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:  # only possible before any inter-op work
+            pass
+        if config.worker_cpu_affinity and num_workers:
+            config._worker_cores = cores[num_threads:]
+            os.sched_setaffinity(0, cores[:num_threads])
+    print(config.log_msg_resource_plan.format(
+        cpu_budget=len(cores),
+        num_workers=config.data_loader_num_workers,
+        num_threads=torch.get_num_threads(),
+        num_interop_threads=torch.get_num_interop_threads(),
+        config=config))
@@ -0,0 +1,208 @@
+"""
+Micro-benchmarks of performance sensitive parts of MedAL.
+
+    python -m medal.benchmarks -h
+    python -m medal.benchmarks selection
+    python -m medal.benchmarks metrics
+    python -m medal.benchmarks cpu_mode
+"""
+import argparse as ap
+import time
+import torch
+import types
+
+
+def timeit(fn, *args, repeat=3, **kwargs):
+    """Return the best wall time in seconds of `repeat` calls to fn"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_selection(ns):
+    """Compare the diversity selection methods on synthetic embeddings.
+
+    Report wall time and the k-center objective: the max distance from any
+    candidate to its nearest labeled or picked point (lower is better)."""
+    from .model_configs import medal
+
+    def coverage(embedding_labeled, embedding_unlabeled, picked):
+        centers = torch.cat([embedding_labeled, embedding_unlabeled[picked]])
+        return max(
+            torch.cdist(chunk, centers).min(1)[0].max().item()
+            for chunk in embedding_unlabeled.split(4096))
+
+    methods = {
+        'centroid': lambda L, U, idxs, k: medal.select_farthest_from_centroid(
+            L, U, idxs, k),
+        'kcenter': lambda L, U, idxs, k: medal.select_kcenter_greedy(
+            L, U, idxs, k),
+        'kcenter+kmeans': lambda L, U, idxs, k: medal.select_kcenter_greedy(
+            L, U, idxs, k, num_clusters=ns.num_clusters),
+    }
+    print("method num_candidates num_picks seconds coverage")
+    for num_candidates, num_picks in [
+            (50, 20), (1000, 100), (10000, 200), (100000, 500)]:
+        torch.manual_seed(0)
+        L = torch.randn(ns.num_labeled, ns.dim, device=ns.device)
+        U = torch.randn(num_candidates, ns.dim, device=ns.device)
+        idxs = torch.arange(num_candidates, device=ns.device)
+        for name, fn in methods.items():
+            if name == 'kcenter+kmeans' and num_candidates <= ns.num_clusters:
+                continue
+            seconds = timeit(fn, L, U, idxs, num_picks, repeat=ns.repeat)
+            picked = fn(L, U, idxs, num_picks)
+            print(name, num_candidates, num_picks, "%.4f" % seconds,
+                  "%.3f" % coverage(L, U, picked))
+
+
+def bench_metrics(ns):
+    """Compare reading back the loss and accuracy every batch to reading them
+    back with feedforward.read_metrics every log_msg_minibatch_interval.
+
+    Runs a small training loop on random data and reports wall time per batch
+    of each.  Both must compute the same metrics."""
+    from .model_configs import feedforward
+
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(
+        torch.nn.Conv2d(3, 16, 3, padding=1), torch.nn.ReLU(),
+        torch.nn.AdaptiveAvgPool2d(1), torch.nn.Flatten(),
+        torch.nn.Linear(16, 1), torch.nn.Sigmoid()).to(ns.device)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    lossfn = torch.nn.BCELoss()
+    X = torch.rand(ns.batch_size, 3, ns.img_size, ns.img_size,
+                   device=ns.device)
+    y = torch.randint(0, 2, (ns.batch_size, 1), device=ns.device)
+
+    def step():
+        optimizer.zero_grad()
+        yhat = model(X)
+        loss = lossfn(yhat, y.float())
+        loss.backward()
+        optimizer.step()
+        return loss, yhat
+
+    def per_batch():
+        totloss, correct = 0, 0
+        for batch_idx in range(ns.num_batches):
+            loss, yhat = step()
+            with torch.no_grad():
+                totloss += loss.item() * X.shape[0]
+                correct += y.int().eq(
+                    (yhat.view_as(y) > .5).int()).sum().item()
+        return totloss, correct
+
+    def deferred():
+        totloss, correct, pending = 0, 0, []
+        for batch_idx in range(ns.num_batches):
+            loss, yhat = step()
+            with torch.no_grad():
+                pending.append((
+                    loss.detach(),
+                    y.int().eq((yhat.view_as(y) > .5).int()).sum(),
+                    X.shape[0]))
+                if batch_idx % ns.interval == ns.interval - 1:
+                    totloss, correct = feedforward.read_metrics(
+                        pending, totloss, correct)
+        return feedforward.read_metrics(pending, totloss, correct)
+
+    print("method seconds_per_batch totloss correct")
+    for name, fn in [('per_batch', per_batch), ('deferred', deferred)]:
+        state = ({k: v.clone() for k, v in model.state_dict().items()},
+                 optimizer.state_dict())
+        seconds = timeit(fn, repeat=ns.repeat)
+        model.load_state_dict(state[0])
+        optimizer.load_state_dict(state[1])
+        totloss, correct = fn()
+        model.load_state_dict(state[0])
+        optimizer.load_state_dict(state[1])
+        print(name, "%.6f" % (seconds / ns.num_batches), totloss, correct)
+
+
+def bench_cpu_mode(ns):
+    """Compare the default and the cpu performance mode of each backbone.
+
+    Report images per second of a training step (forward and backward) and of
+    a no-grad forward pass.  Performance mode is channels_last, and bfloat16
+    autocast unless --no-autocast or unsupported by the cpu."""
+    from . import models
+    from .model_configs import feedforward
+
+    # build models without pre-trained weights
+    config = types.SimpleNamespace(
+        load_pretrained_inception_weights=False,
+        load_pretrained_resnet18_weights=False,
+        load_pretrained_squeezenet_weights=False,
+        activation_checkpoint_segments=0)
+    bf16 = not ns.no_autocast and feedforward.cpu_supports_bf16()
+    print("bfloat16 autocast: %s" % bf16)
+    print("model mode phase imgs_per_sec")
+    for kls in [models.Resnet18BinaryClassifier,
+                models.SqueezeNetBinaryClassifier,
+                models.InceptionV3BinaryClassifier]:
+        torch.manual_seed(0)
+        model = kls(config)
+        X = torch.rand(ns.batch_size, 3, ns.img_size, ns.img_size)
+        for mode in ['default', 'performance']:
+            if mode == 'performance':
+                model.to(memory_format=torch.channels_last)
+                X = X.contiguous(memory_format=torch.channels_last)
+            autocast = dict(device_type='cpu', dtype=torch.bfloat16,
+                            enabled=bf16 and mode == 'performance')
+
+            def train_step():
+                model.train()
+                model.zero_grad()
+                with torch.autocast(**autocast):
+                    yhat = model(X)
+                yhat.float().sum().backward()
+
+            def inference():
+                model.eval()
+                with torch.no_grad(), torch.autocast(**autocast):
+                    model(X)
+
+            for phase, fn in [('train', train_step), ('inference', inference)]:
+                fn()  # warmup
+                seconds = timeit(fn, repeat=ns.repeat)
+                print(kls.__name__, mode, phase,
+                      "%.2f" % (ns.batch_size / seconds))
+
+
+def build_arg_parser():
+    p = ap.ArgumentParser(
+        description=__doc__, formatter_class=ap.RawDescriptionHelpFormatter)
+    p.add_argument('--device', default='cpu')
+    p.add_argument('--repeat', type=int, default=3)
+    sp = p.add_subparsers(dest='benchmark')
+    sp.required = True
+
+    g = sp.add_parser('selection', help=bench_selection.__doc__.split('\n')[0])
+    g.set_defaults(func=bench_selection)
+    g.add_argument('--dim', type=int, default=512)
+    g.add_argument('--num-labeled', type=int, default=1000)
+    g.add_argument('--num-clusters', type=int, default=2000)
+
+    g = sp.add_parser('metrics', help=bench_metrics.__doc__.split('\n')[0])
+    g.set_defaults(func=bench_metrics)
+    g.add_argument('--num-batches', type=int, default=200)
+    g.add_argument('--batch-size', type=int, default=32)
+    g.add_argument('--img-size', type=int, default=32)
+    g.add_argument('--interval', type=int, default=10)
+
+    g = sp.add_parser(
+        'cpu_mode', help=bench_cpu_mode.__doc__.split('\n')[0])
+    g.set_defaults(func=bench_cpu_mode)
+    g.add_argument('--batch-size', type=int, default=8)
+    g.add_argument('--img-size', type=int, default=299)
+    g.add_argument('--no-autocast', action='store_true')
+    return p
+
+
+if __name__ == "__main__":
+    ns = build_arg_parser().parse_args()
+    ns.func(ns)
@@ -4,7 +4,7 @@ Functions to save and load model checkpoints to/from disk
 import glob
 import os
 from os.path import dirname, join
-import torch
+from .lazy import torch
 
 
 def _get_checkpoint_fp(config):
@@ -42,6 +42,10 @@ def load_checkpoint(config):
     This function will only restore the model and optimizer.
     If other data is present, it will be returned
 
+    Keys of config.get_checkpoint_extra_state() are restored onto config.
+    A missing key fails, unless it is in config._checkpoint_optional_keys,
+    ie a key older checkpoints don't have.
+
     If multiple filepaths match, fail.
     """
     read_fp = _get_checkpoint_fp(config)
@@ -59,9 +63,12 @@ def load_checkpoint(config):
         config.optimizer.load_state_dict(
             checkpoint['optimizer_state_dict'])
 
+        optional_keys = getattr(config, '_checkpoint_optional_keys', ())
         for k in config.get_checkpoint_extra_state():
             if k not in checkpoint:
-                raise Exception("The key %s was not found in checkpoint")
+                if k in optional_keys:
+                    continue
+                raise Exception("The key %s was not found in checkpoint" % k)
             setattr(config, k, checkpoint[k])
         return checkpoint
     else:
@@ -2,19 +2,32 @@
 Tooling to initialize and run models from commandline
 """
 import configargparse as ap
-import torch
+import os
+import sys
 
 from . import model_configs as MC
 
 
 def main(ns: ap.Namespace):
     """Initialize model and run from command-line"""
+    if ns.compile_model:
+        # keep compiled kernels under base_dir, so later runs reuse them.
+        # Must be set before torch._inductor or torchvision is imported, which
+        # set it to a default.
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath(
+            os.path.join(ns.base_dir, 'torch/compile_cache')))
 
     # merge cmdline config with defaults
     config_overrides = ns.__dict__
+    dry_run = config_overrides.pop('dry_run')
     config = config_overrides.pop('modelconfig_class')(config_overrides)
     print('\n'.join(str((k, v)) for k, v in config.__dict__.items()
                     if not k.startswith('_')))
+    if dry_run:
+        return
+    import torch
+    if not config.device:
+        config.device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
     # assign model to cuda device if necessary
     if config.device == 'cuda' and torch.cuda.device_count() > 1:
@@ -22,6 +35,15 @@ def main(ns: ap.Namespace):
         # dim = 0 [30, xxx] -> [10, ...], [10, ...], [10, ...] on 3 GPUs
         config.model = torch.nn.DataParallel(config.model)
     config.model.to(config.device)
+    if config.cpu_performance_mode and config.device == 'cpu':
+        from .model_configs import feedforward
+        feedforward.enable_cpu_performance_mode(config)
+
+    from . import autotune
+    if config.auto_batch_size:
+        autotune.tune_batch_sizes(config)
+    # calibrate the resource plan with the tuned batch size
+    autotune.plan_resources(config)
 
     config.load_checkpoint()
 
@@ -86,6 +108,9 @@ def add_subparser(subparsers, name: str, modelconfig_class: type):
         name, formatter_class=ap.ArgumentDefaultsHelpFormatter)
     g.add_argument(
         '--modelconfig_class', help=ap.SUPPRESS, default=modelconfig_class)
+    g.add_argument(
+        '--dry-run', action='store_true',
+        help="Print the config and exit without building the model or data")
 
     # add an argument for each configurable key that we can work with
     keys = _add_subparser_find_configurable_attributes(modelconfig_class)
@@ -96,20 +121,26 @@ def add_subparser(subparsers, name: str, modelconfig_class: type):
             _add_subparser_arg(grp, k, v, modelconfig_class)
 
 
-def build_arg_parser():
-    """Returns a parser to handle command-line arguments"""
+def build_arg_parser(argv=None):
+    """Returns a parser to handle command-line arguments.
+
+    Only the model config named in argv (default sys.argv) gets its options
+    added to the parser, since that requires importing the config class.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    chosen = next((x for x in argv if x in MC.__all__), None)
+
     p = ap.ArgumentParser(
         formatter_class=ap.ArgumentDefaultsHelpFormatter)
     sp = p.add_subparsers(help='The model configuration to work with')
     sp.required = True
     sp.dest = 'model_configuration_name'
 
-    for kls_name in dir(MC):
-        if kls_name.startswith("_"):
-            continue
-        # add all available model config classes as command line options
-        mc_obj = getattr(MC, kls_name)
-        if isinstance(mc_obj, type) \
-                and issubclass(mc_obj, MC.feedforward.FeedForwardModelConfig):
-            add_subparser(sp, mc_obj.__name__, mc_obj)
+    # add all available model config classes as command line options
+    for kls_name in MC.__all__:
+        if kls_name == chosen:
+            add_subparser(sp, kls_name, getattr(MC, kls_name))
+        else:
+            sp.add_parser(kls_name)
     return p
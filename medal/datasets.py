@@ -3,11 +3,102 @@ Load datasets
 """
 import PIL.Image
 import glob
+import io
 import numpy as np
 import pandas as pd
 import os.path
+import random
+import re
+import tempfile
 import torch.utils.data as TD
-from sklearn.model_selection import train_test_split
+from multiprocessing.pool import ThreadPool
+
+
+def _compact_array(series):
+    """Return the values of a pandas Series as the smallest numpy array that
+    holds them.  Integers are downcast and text becomes a fixed width array"""
+    if series.dtype.kind in 'iu':
+        return pd.to_numeric(series, downcast='integer').values
+    elif series.dtype.kind == 'O':
+        return series.values.astype(str)
+    return series.values
+
+
+def _read_file_info(fp):
+    """Return file size, mtime and image dimensions of an image file.
+    PIL only reads the image header until the pixel data is needed"""
+    st = os.stat(fp)
+    with PIL.Image.open(fp) as im:
+        return (fp, st.st_size, st.st_mtime,
+                im.height, im.width, len(im.getbands()))
+
+
+def _dir_mtimes(glob_expr, fps):
+    """Return the mtime of each directory between the non-wildcard root of
+    glob_expr and the given files.  Adding, removing or renaming a file or
+    directory changes the mtime of its parent directory."""
+    root = os.path.dirname(re.split(r'[*?[]', glob_expr)[0])
+    dirs = {root}
+    for fp in fps:
+        d = os.path.dirname(fp)
+        while d not in dirs and len(d) > len(root):
+            dirs.add(d)
+            d = os.path.dirname(d)
+    return {d: os.stat(d or '.').st_mtime for d in dirs}
+
+
+def build_manifest(glob_expr, fps=None, num_workers=None):
+    """Find the files matching glob_expr and read their sizes, mtimes and
+    image dimensions, using a pool of threads.  Return a manifest dict"""
+    if fps is None:
+        fps = glob.glob(glob_expr, recursive=True)
+    with ThreadPool(num_workers or os.cpu_count()) as pool:
+        rows = pool.map(_read_file_info, fps, chunksize=16)
+    return {
+        'glob_expr': glob_expr,
+        'dir_mtimes': _dir_mtimes(glob_expr, fps) if glob_expr else {},
+        'files': pd.DataFrame(rows, columns=[
+            'fp', 'size', 'mtime', 'height', 'width', 'bands']),
+        'metadata': None,  # ie the Messidor csv data, set by the dataset
+        'metadata_mtimes': None,
+        'splits': {},  # train/val splits with a fixed random_state
+    }
+
+
+def load_manifest(manifest_fp, glob_expr):
+    """Return the manifest saved at manifest_fp if it is still valid for the
+    given glob expression, or build and save a new one.
+
+    A manifest is valid while the mtimes of the directories it covers are
+    unchanged, so checking it costs one stat per directory.  Files modified
+    in place are not detected.  Delete the manifest to rebuild it.
+    The manifest_fp should be outside of the directories that glob_expr
+    searches, or saving it would invalidate it."""
+    if os.path.exists(manifest_fp):
+        manifest = pd.read_pickle(manifest_fp)
+        try:
+            if manifest['glob_expr'] == glob_expr and all(
+                    os.stat(d or '.').st_mtime == mtime
+                    for d, mtime in manifest['dir_mtimes'].items()):
+                return manifest
+        except FileNotFoundError:
+            pass
+    print("Build manifest", manifest_fp)
+    manifest = build_manifest(glob_expr)
+    save_manifest(manifest, manifest_fp)
+    return manifest
+
+
+def save_manifest(manifest, manifest_fp):
+    """Atomically replace the manifest at manifest_fp.  Each call writes its
+    own temporary file, so concurrent runs don't clobber each other's"""
+    dirname = os.path.dirname(manifest_fp) or '.'
+    os.makedirs(dirname, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+            dir=dirname, prefix=os.path.basename(manifest_fp),
+            suffix='.tmp', delete=False) as fout:
+        pd.to_pickle(manifest, fout)
+    os.replace(fout.name, manifest_fp)
 
 
 class GlobImageDir(TD.Dataset):
@@ -17,22 +108,40 @@ class GlobImageDir(TD.Dataset):
     >>> GlobDir("./data/**/*.png")  # fetch PNG images recursively under ./data
     >>> GlobDir("./data/*/*.png")  # fetch images from the grandchild dirs
     >>> GlobDir("*.png", mytranform_fn)  # fetch and transform PNG files
+
+    If manifest_fp is given, keep the file list in a manifest there and reuse
+    it on later runs instead of globbing (see load_manifest).
     """
 
-    def __init__(self, glob_expr, transform=None):
-        self.fps = glob.glob(glob_expr, recursive=True)
+    def __init__(self, glob_expr, transform=None, manifest_fp=None):
+        self.manifest_fp = manifest_fp
+        # the loaded manifest.  Not copied to data loader workers
+        self._manifest = None
+        if manifest_fp:
+            self._manifest = load_manifest(manifest_fp, glob_expr)
+            self.fps = self._manifest['files']['fp'].tolist()
+        else:
+            self.fps = glob.glob(glob_expr, recursive=True)
         self.transform = transform
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_manifest'] = None
+        return state
+
     def __len__(self):
         return len(self.fps)
 
     def __getitem__(self, index):
         fp = self.fps[index]
-        with PIL.Image.open(fp) as im:
+        with self.open_image(index) as im:
             if self.transform:
                 im = self.transform(im)
             return {'image': im, 'fp': fp}
 
+    def open_image(self, index):
+        return PIL.Image.open(self.fps[index])
+
 
 class Messidor(GlobImageDir):
     """Load Messidor Dataset, applying given transforms.
@@ -55,19 +164,33 @@ class Messidor(GlobImageDir):
         )
     """
     def __init__(self, csv_glob_expr, img_glob_expr,
-                 img_transform=None, getitem_transform=None):
-        super().__init__(img_glob_expr, img_transform)
+                 img_transform=None, getitem_transform=None,
+                 manifest_fp=None):
+        super().__init__(img_glob_expr, img_transform, manifest_fp)
         self.getitem_transform = getitem_transform
-        self.csv_data = pd.concat([
-            pd.read_csv(x) for x in glob.glob(csv_glob_expr, recursive=True)])\
-            .set_index('Image name')
-        assert self.csv_data.shape[0] == len(self.fps)  # sanity check
+        csv_fps = glob.glob(csv_glob_expr, recursive=True)
+        csv_mtimes = {fp: os.stat(fp).st_mtime for fp in csv_fps}
+        manifest = self._manifest
+        if manifest is not None and manifest['metadata_mtimes'] == csv_mtimes:
+            self.metadata = manifest['metadata']
+        else:
+            csv_data = pd.concat([pd.read_csv(x) for x in csv_fps])\
+                .set_index('Image name')
+            assert csv_data.shape[0] == len(self.fps)  # sanity check
+            # keep one compact array per csv column, aligned with self.fps, so
+            # getitem is a plain array lookup and the dataset pickles small.
+            csv_data = csv_data.loc[[os.path.basename(fp) for fp in self.fps]]
+            self.metadata = {
+                col: _compact_array(csv_data[col]) for col in csv_data.columns}
+            if manifest is not None:
+                manifest['metadata'] = self.metadata
+                manifest['metadata_mtimes'] = csv_mtimes
+                save_manifest(manifest, manifest_fp)
         self.shape_data = None  # populate this requires pass through all imgs
 
     def __getitem__(self, index, getitem_transform=True):
         sample = super().__getitem__(index)
-        fname = os.path.basename(sample['fp'])
-        sample.update(dict(self.csv_data.loc[fname]))
+        sample.update({k: v[index] for k, v in self.metadata.items()})
         if getitem_transform and self.getitem_transform is not None:
             return self.getitem_transform(sample)
         else:
@@ -87,28 +210,45 @@ class Messidor(GlobImageDir):
 
         train_frac: a value in [0, 1]
         random_state: passed to sklearn.model_selection.train_test_split
+
+        If random_state is given and the dataset has a manifest, the split is
+        saved in the manifest and reused.
         """
+        from sklearn.model_selection import train_test_split
+        manifest = None
+        if self._manifest is not None and random_state is not None:
+            manifest = self._manifest
+            if (train_frac, random_state) in manifest['splits']:
+                return manifest['splits'][(train_frac, random_state)]
+
         # input num samples
         N = len(self)
 
         train_idxs, val_idxs = train_test_split(
-            np.arange(N), train_size=train_frac,
-            stratify=self.csv_data['Ophthalmologic department'].values)
+            np.arange(N), train_size=train_frac, random_state=random_state,
+            stratify=self.metadata['Ophthalmologic department'])
+        if manifest is not None:
+            manifest['splits'][(train_frac, random_state)] = \
+                (train_idxs, val_idxs)
+            save_manifest(manifest, self.manifest_fp)
         return train_idxs, val_idxs
 
     def fetch_img_dims(self):
         """
-        Iteratively load all images in dataset and store their shape
-        in a dataframe.  Useful for analysis.  Takes a minute or so.
+        Get the shape (height, width, bands) of all images in the dataset
+        in a dataframe.  Useful for analysis.  Reads only image headers, or
+        uses the manifest if there is one.
 
         #  # file dimensions are not uniform.
         #  # base 1 and base 2 have unique dimension.
         #  # base 3 has 2 different dimensions.
         #  df.groupby(['base', 'x', 'y', 'z'])['fp'].count()
         """
-        df = pd.DataFrame(
-            {fp: list(self[i].shape)
-             for i, fp in zip(range(len(self.fps)), self.fps)})
+        if self._manifest is not None:
+            files = self._manifest['files']
+        else:
+            files = build_manifest(None, self.fps)['files']
+        df = files[['fp', 'height', 'width', 'bands']].copy()
         df.columns = ['fp', 'x', 'y', 'z']
         df = pd.concat([df, df['fp'].str.extract(
             r'/Base(?P<base>\d)(?P<base2>\d)/').astype('int')], axis=1)
@@ -117,6 +257,126 @@ class Messidor(GlobImageDir):
         return df
 
 
+def pack_shards(dataset, shards_dir, shard_size=2**30):
+    """Pack the image files and metadata of a Messidor dataset into a few
+    large shard files that can be read sequentially, and an index.
+
+    Each shard is the raw (still encoded) image files concatenated together,
+    up to about shard_size bytes.  The index, shards_dir/index.csv, has one row
+    per image with its shard, byte offset and length, and the metadata.
+    Load the result with ShardedMessidor(shards_dir).
+
+        >>> pack_shards(
+            Messidor("./data/messidor/*.csv", "./data/messidor/**/*.tif"),
+            "./data/messidor_shards")
+    """
+    os.makedirs(shards_dir, exist_ok=True)
+    index = {'fp': dataset.fps, 'shard': [], 'offset': [], 'length': []}
+    shard, offset, fout = -1, 0, None
+    for fp in dataset.fps:
+        if fout is None or offset >= shard_size:
+            if fout is not None:
+                fout.close()
+            shard, offset = shard + 1, 0
+            fout = open(
+                os.path.join(shards_dir, 'shard_%05d.bin' % shard), 'wb')
+        with open(fp, 'rb') as fin:
+            data = fin.read()
+        fout.write(data)
+        index['shard'].append(shard)
+        index['offset'].append(offset)
+        index['length'].append(len(data))
+        offset += len(data)
+    if fout is not None:
+        fout.close()
+    index.update(dataset.metadata)
+    pd.DataFrame(index).to_csv(
+        os.path.join(shards_dir, 'index.csv'), index=False)
+
+
+class ShardedMessidor(Messidor):
+    """Load the Messidor Dataset from the shard files written by pack_shards.
+
+    Supports the same index-based access as Messidor, but reads each image
+    from a large shard file instead of opening one file per image.  For
+    training, use random_sampler(idxs) instead of a SubsetRandomSampler, so
+    shards are read sequentially.
+    """
+    def __init__(self, shards_dir, img_transform=None,
+                 getitem_transform=None):
+        # the file list and metadata come from the index, not from globs
+        index = pd.read_csv(os.path.join(shards_dir, 'index.csv'))
+        self.shards_dir = shards_dir
+        self.fps = index['fp'].tolist()
+        self.transform = img_transform
+        self.getitem_transform = getitem_transform
+        self.manifest_fp = None
+        self._manifest = None
+        self.shard = index['shard'].values.astype('int32')
+        self.offset = index['offset'].values.astype('int64')
+        self.length = index['length'].values.astype('int64')
+        self.metadata = {
+            col: _compact_array(index[col]) for col in index.columns
+            if col not in ('fp', 'shard', 'offset', 'length')}
+        self.shape_data = None
+        # file descriptors of open shards.  Reads use os.pread, which doesn't
+        # move the shared file offset, so processes forked after a shard was
+        # open, ie data loader workers, can read from the same descriptor.
+        self._fds = {}
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['_fds'] = {}
+        return state
+
+    def open_image(self, index):
+        shard = self.shard[index]
+        if shard not in self._fds:
+            self._fds[shard] = os.open(os.path.join(
+                self.shards_dir, 'shard_%05d.bin' % shard), os.O_RDONLY)
+        data = os.pread(
+            self._fds[shard], int(self.length[index]),
+            int(self.offset[index]))
+        return PIL.Image.open(io.BytesIO(data))
+
+    def random_sampler(self, idxs, buffer_size=256):
+        return ShardBufferedRandomSampler(self, idxs, buffer_size)
+
+
+class ShardBufferedRandomSampler(TD.Sampler):
+    """Sample the given indexes of a ShardedMessidor in random order, while
+    reading the shards sequentially.  Visit the shards in a random order, read
+    the indexes of each shard in file order, and shuffle them through a buffer
+    of buffer_size items.
+
+    Like SubsetRandomSampler, self.indices are the given dataset indexes.
+    """
+    def __init__(self, dataset, indices, buffer_size=256):
+        self.dataset = dataset
+        self.indices = np.asarray(indices)
+        self.buffer_size = buffer_size
+
+    def __iter__(self):
+        shards = self.dataset.shard[self.indices]
+        shard_rank = np.empty(shards.max() + 1 if len(shards) else 0, 'int64')
+        shard_rank[np.random.permutation(len(shard_rank))] = \
+            np.arange(len(shard_rank))
+        ordered = self.indices[np.lexsort((
+            self.dataset.offset[self.indices], shard_rank[shards]))]
+        buffer = []
+        for idx in ordered.tolist():
+            buffer.append(idx)
+            if len(buffer) >= self.buffer_size:
+                j = random.randrange(len(buffer))
+                buffer[j], buffer[-1] = buffer[-1], buffer[j]
+                yield buffer.pop()
+        random.shuffle(buffer)
+        yield from buffer
+
+    def __len__(self):
+        return len(self.indices)
+
+
 if __name__ == "__main__":
     messidor = Messidor(
         "./data/messidor/*.csv",
@@ -0,0 +1,156 @@
+"""
+Cache the features a frozen backbone computes for each image, so the top
+layers can be trained and evaluated without decoding images or running the
+backbone every epoch.  Useful for linear-probe experiments, ie with
+--no-trainable-resnet-layers.
+"""
+import hashlib
+import json
+import numpy as np
+import os
+from os.path import exists, join
+import torch
+
+
+class FeatureCache:
+    """Backbone features of every image in a dataset.
+
+    features - array of shape (num_views, len(dataset), ...).  Each view is
+        one pass over the dataset with the dataset's (random) augmentation.
+    eval_features - array of shape (len(dataset), ...).  One pass over the
+        dataset without augmentation, for validation.
+    labels - array of shape (len(dataset), ...)
+
+    Any array may be a numpy memmap of a file on disk.
+    """
+    def __init__(self, features, eval_features, labels):
+        self.features = features
+        self.eval_features = eval_features
+        self.labels = labels
+
+    def iter_batches(self, data_loader, train=True):
+        """Yield (features, y) batches of the same dataset indexes and batch
+        size the given data loader would use.  If train, pick a random view
+        for each sample, otherwise use the eval view."""
+        idxs = np.array(list(data_loader.sampler), dtype='int64')
+        num_views = self.features.shape[0]
+        for start in range(0, len(idxs), data_loader.batch_size):
+            batch = idxs[start:start + data_loader.batch_size]
+            if train:
+                views = np.random.randint(num_views, size=batch.shape)
+                X = self.features[views, batch]
+            else:
+                X = self.eval_features[batch]
+            yield (torch.from_numpy(X), torch.from_numpy(self.labels[batch]))
+
+
+def check_backbone_frozen(config, model):
+    """Raise a ValueError unless no parameter of the model's backbone
+    requires grad.  Otherwise the cached features would go stale as soon as
+    the backbone trains."""
+    X = torch.rand(1, 3, config.cur_img_size, config.cur_img_size,
+                   device=config.device)
+    was_training = model.training
+    model.eval()  # don't update the BatchNorm running stats
+    with torch.enable_grad():
+        requires_grad = model.forward_features(X).requires_grad
+    model.train(was_training)
+    if requires_grad:
+        raise ValueError(
+            "feature_cache_views requires a frozen backbone, ie"
+            " --no-trainable-resnet-layers")
+
+
+def get_cache_metadata(config, model):
+    """Return what the cached features depend on: the model, the weights of
+    its frozen parameters and its buffers, the image size and augmentation,
+    the number of views and the dataset's length"""
+    weights = hashlib.sha1()
+    params = dict(model.named_parameters())
+    for name, tensor in model.state_dict().items():
+        if name in params and params[name].requires_grad:
+            continue  # ie the top layers
+        weights.update(name.encode())
+        weights.update(
+            tensor.detach().cpu().reshape(-1).view(torch.uint8).numpy())
+    return {
+        'model': type(model).__name__,
+        'weights': weights.hexdigest(),
+        'img_size': config.cur_img_size,
+        'batch_augmentation': config.batch_augmentation,
+        'views': config.feature_cache_views,
+        'dataset_len': len(config.dataset),
+    }
+
+
+def _compute_features(config, model, data_loader, train):
+    """Return (features, labels) of one pass over the data loader"""
+    from .model_configs import feedforward
+    features, labels = [], []
+    for X, y in feedforward.device_batches(config, data_loader):
+        X = feedforward.preprocess_batch(config, X, train=train)
+        features.append(model.forward_features(X).cpu())
+        labels.append(y.cpu())
+    return torch.cat(features).numpy(), torch.cat(labels).numpy()
+
+
+def build_feature_cache(config):
+    """Run every image in config.dataset through the backbone of the model
+    config.feature_cache_views times with augmentation, and once without,
+    and return a FeatureCache.
+
+    The backbone runs in eval mode, so BatchNorm uses its running statistics.
+    If config.feature_cache_dir is set, save the arrays there, or reuse them
+    if a previous run saved them with the same metadata (see
+    get_cache_metadata).
+    """
+    from .model_configs import feedforward
+
+    model = getattr(config.model, 'module', config.model)
+    check_backbone_frozen(config, model)
+    metadata = get_cache_metadata(config, model)
+    cache_dir = config.feature_cache_dir.format(config=config)
+    if cache_dir and exists(join(cache_dir, 'metadata.json')):
+        with open(join(cache_dir, 'metadata.json')) as fin:
+            if json.load(fin) == metadata:
+                print("Load feature cache", cache_dir)
+                return FeatureCache(
+                    np.load(join(cache_dir, 'features.npy'), mmap_mode='r'),
+                    np.load(join(cache_dir, 'eval_features.npy'),
+                            mmap_mode='r'),
+                    np.load(join(cache_dir, 'labels.npy')))
+        print("Feature cache is stale, rebuild it", cache_dir)
+
+    was_training = model.training
+    model.eval()
+    data_loader = feedforward.create_data_loader(
+        config, np.arange(len(config.dataset)), shuffle=False,
+        batch_size=config.eval_batch_size)
+    features = []
+    with torch.no_grad():
+        for view in range(config.feature_cache_views):
+            print("Build feature cache, view %s" % view)
+            _features, labels = _compute_features(
+                config, model, data_loader, train=True)
+            features.append(_features)
+        print("Build feature cache, eval view")
+        transform = config.dataset.transform
+        config.dataset.transform = config.get_img_transform(train=False)
+        try:
+            eval_features, _ = _compute_features(
+                config, model, data_loader, train=False)
+        finally:
+            config.dataset.transform = transform
+    model.train(was_training)
+    features = np.stack(features)
+
+    if cache_dir:
+        print("Save feature cache", cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(join(cache_dir, 'features.npy'), features)
+        np.save(join(cache_dir, 'eval_features.npy'), eval_features)
+        np.save(join(cache_dir, 'labels.npy'), labels)
+        # written last, so an interrupted save is rebuilt
+        with open(join(cache_dir, 'metadata.json'), 'w') as fout:
+            json.dump(metadata, fout, indent=2, sort_keys=True)
+    return FeatureCache(features, eval_features, labels)
@@ -0,0 +1,22 @@
+"""
+Inference copies of a model with BatchNorm folded into the preceding
+convolutions, so no-grad passes skip the BatchNorm passes over memory.
+"""
+import copy
+
+
+def build_folded_model(model):
+    """Return a copy of the model for inference.  The given model is not
+    modified, so this is cheap to redo from the live training weights.
+
+    Models may define fold_transform_input() to fold input normalization
+    into their first layer, ie InceptionV3BinaryClassifier.  Then each
+    BatchNorm is folded into the convolution before it, using its running
+    statistics.  Returns an eval mode torch.fx GraphModule.
+    """
+    from torch.fx.experimental.optimization import fuse
+    model = copy.deepcopy(model).eval()
+    for module in model.modules():
+        if hasattr(module, 'fold_transform_input'):
+            module.fold_transform_input()
+    return fuse(model, inplace=True).eval()
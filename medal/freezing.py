@@ -0,0 +1,98 @@
+"""
+Freeze layers of the model on a schedule, so later epochs or al iters skip
+their backward pass and optimizer update.
+"""
+from .lazy import torch
+
+
+def parse_freeze_schedule(schedule):
+    """Parse a schedule like "2:a+b,5:c" into a sorted list of
+    (start, [layer names]) tuples"""
+    rv = []
+    for item in schedule.split(','):
+        start, names = item.split(':')
+        rv.append((int(start), names.split('+')))
+    return sorted(rv)
+
+
+def get_frozen_layer_names(schedule, step):
+    """Return the names of all layers the schedule freezes by the given step"""
+    return [name for start, names in parse_freeze_schedule(schedule)
+            if step >= start for name in names]
+
+
+def estimate_backward_flops(model, img_size, device):
+    """Estimate the backward pass flops per image of the convolution and
+    linear layers of the model, given which parameters require grad.
+    Return (flops if all layers were trainable, flops now).
+
+    A layer computes the gradient of its weights if it is trainable, and
+    the gradient of its input if any layer before it is trainable.  Each
+    costs about as much as the layer's forward pass.
+    """
+    forward_flops = []  # (layer, flops) in the order the layers run
+
+    def hook(layer, inpt, output):
+        if isinstance(layer, torch.nn.Conv2d):
+            flops = 2 * output.numel() * layer.in_channels // layer.groups \
+                * layer.kernel_size[0] * layer.kernel_size[1]
+        else:
+            flops = 2 * output.numel() * layer.in_features
+        forward_flops.append((layer, flops))
+    handles = [layer.register_forward_hook(hook) for layer in model.modules()
+               if isinstance(layer, (torch.nn.Conv2d, torch.nn.Linear))]
+    was_training = model.training
+    model.eval()
+    with torch.no_grad():
+        model(torch.rand(1, 3, img_size, img_size, device=device))
+    model.train(was_training)
+    for handle in handles:
+        handle.remove()
+
+    total_flops, flops, any_trainable_before = 0, 0, False
+    for n, (layer, _flops) in enumerate(forward_flops):
+        total_flops += _flops * (2 if n else 1)
+        if any_trainable_before:
+            flops += _flops
+        if any(p.requires_grad for p in layer.parameters()):
+            flops += _flops
+            any_trainable_before = True
+    return total_flops, flops
+
+
+def update_frozen_layers(config, step):
+    """Apply config.freeze_schedule for the given epoch or al iter.
+
+    Frozen parameters stop requiring grad, and their gradients and optimizer
+    state are dropped, so the optimizer skips them.  Layers the schedule no
+    longer freezes, ie when epochs restart at the next al iter, are unfrozen
+    again.  Only parameters this function froze are unfrozen, so parameters
+    made untrainable by the model's set_layers_trainable stay frozen.  If the
+    frozen layers change, log the estimated backward flops saved.
+    """
+    names = get_frozen_layer_names(config.freeze_schedule, step)
+    if names == config._frozen_layer_names:
+        return
+    model = getattr(config.model, 'module', config.model)
+    params = {id(p): p for name in names
+              for p in model.get_submodule(name).parameters()}
+    frozen_params = []
+    for p in config._frozen_params:
+        if id(p) in params:
+            frozen_params.append(p)
+        else:
+            p.requires_grad = True
+    for p in params.values():
+        if p.requires_grad:
+            p.requires_grad = False
+            p.grad = None
+            config.optimizer.state.pop(p, None)
+            frozen_params.append(p)
+    config._frozen_params = frozen_params
+    config._frozen_layer_names = names
+    num_frozen_params = sum(p.numel() for p in frozen_params)
+    total_flops, flops = estimate_backward_flops(
+        model, config.cur_img_size, config.device)
+    print(config.log_msg_freeze.format(
+        frozen_layers='+'.join(names),
+        backward_flops_saved_frac=1 - flops / total_flops, **locals()))
@@ -0,0 +1,25 @@
+"""
+Lazily loaded modules.  The model config modules use these, so the
+command-line help and --dry-run don't load torch, which takes seconds.
+
+    >>> from .lazy import torch  # loaded on first attribute access
+"""
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """Return the module with the given name.  If it isn't imported yet,
+    return a module that is only loaded on first attribute access, and put it
+    in sys.modules so later imports share it"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+torch = lazy_import('torch')
@@ -1,9 +1,32 @@
-from .baseline_inception import BaselineInceptionV3BinaryClassifier
-from .baseline_squeezenet import BaselineSqueezeNetBinaryClassifier
-from .baseline_resnet18 import BaselineResnet18BinaryClassifier
-from .medal import (
-    MedalInceptionV3BinaryClassifier,
-    MedalSqueezeNetBinaryClassifier,
-    MedalResnet18BinaryClassifier,
-    OnlineMedalResnet18BinaryClassifier
-)
+"""
+The available model configs.  Each config class is imported on first access,
+so listing the configs (ie for the command-line help) does not import torch,
+torchvision or the datasets.
+"""
+import importlib
+
+
+# map each config class name to the module that defines it
+_config_modules = {
+    'BaselineInceptionV3BinaryClassifier': 'baseline_inception',
+    'BaselineSqueezeNetBinaryClassifier': 'baseline_squeezenet',
+    'BaselineResnet18BinaryClassifier': 'baseline_resnet18',
+    'MedalInceptionV3BinaryClassifier': 'medal',
+    'MedalSqueezeNetBinaryClassifier': 'medal',
+    'MedalResnet18BinaryClassifier': 'medal',
+    'OnlineMedalResnet18BinaryClassifier': 'medal',
+}
+__all__ = list(_config_modules)
+
+
+def __getattr__(name):
+    if name not in _config_modules:
+        raise AttributeError(
+            "module %r has no attribute %r" % (__name__, name))
+    module = importlib.import_module(
+        '.%s' % _config_modules[name], __name__)
+    return getattr(module, name)
+
+
+def __dir__():
+    return sorted(set(globals()).union(__all__))
@@ -1,11 +1,7 @@
 from os.path import join
-import torch
-import torch.optim
-import torchvision.transforms as tvt
 
 from . import feedforward
-from .. import datasets
-from .. import models
+from ..lazy import torch
 
 
 class BaselineSqueezeNetBinaryClassifier(feedforward.FeedForwardModelConfig):
@@ -13,12 +9,21 @@ class BaselineSqueezeNetBinaryClassifier(feedforward.FeedForwardModelConfig):
     batch_size = 16
     learning_rate = 0.01
     train_frac = .8
+    # random_state of the train/val split.  The split is saved in the
+    # messidor manifest and reused.  -1 for a new random split each run
+    train_test_split_random_state = 0
     weight_decay = 0.01
     trainable_squeezenet_layers = True
     trainable_top_layers = True
     load_pretrained_squeezenet_weights = True
+    # load messidor from files written by datasets.pack_shards, if given
+    messidor_shards_dir = ''
+    # cache the messidor file list, image dims and csv data here, relative to
+    # base_dir.  Empty string to disable.  See datasets.load_manifest
+    messidor_manifest_fname = 'messidor_manifest.pkl'
 
     def get_model(self):
+        from .. import models
         model = models.SqueezeNetBinaryClassifier(self)
         model.set_layers_trainable(
             squeezenet_layers=self.trainable_squeezenet_layers,
@@ -33,26 +38,36 @@ class BaselineSqueezeNetBinaryClassifier(feedforward.FeedForwardModelConfig):
             self.model.parameters(), lr=self.learning_rate, momentum=0.5,
             weight_decay=self.weight_decay, nesterov=True)
 
+    def get_img_transform(self, train=True):
+        # import here so the command-line starts without torchvision
+        from .. import augmentation
+        return augmentation.get_messidor_img_transform(
+            self, self.cur_img_size, train=train)
+
     def get_dataset(self):
+        # import here so the command-line starts without pandas
+        from .. import datasets
+        kws = dict(
+            img_transform=self.get_img_transform(),
+            getitem_transform=lambda x: (
+                x['image'],
+                torch.tensor([float(x['Retinopathy grade'] != 0)])))
+        if self.messidor_shards_dir:
+            return datasets.ShardedMessidor(self.messidor_shards_dir, **kws)
+        if self.messidor_manifest_fname:
+            kws['manifest_fp'] = join(
+                self.base_dir, self.messidor_manifest_fname)
         return datasets.Messidor(
             join(self.base_dir, "messidor/*.csv"),
             join(self.base_dir, "messidor/**/*.tif"),
-            img_transform=tvt.Compose([
-                tvt.RandomRotation(degrees=15),
-                tvt.RandomResizedCrop(
-                    512, scale=(0.9, 1.0), ratio=(1, 1)),
-                tvt.RandomHorizontalFlip(),
-                #  tvt.RandomVerticalFlip(),
-                tvt.ToTensor(),
-            ]),
-            getitem_transform=lambda x: (
-                x['image'],
-                torch.tensor([float(x['Retinopathy grade'] != 0)]))
-        )
+            **kws)
 
     def get_data_loaders(self):
+        random_state = self.train_test_split_random_state
         train_idxs, val_idxs = self.dataset.train_test_split(
-            train_frac=self.train_frac)
+            train_frac=self.train_frac,
+            random_state=None if random_state < 0 else random_state)
         return (
             feedforward.create_data_loader(self, train_idxs),
-            feedforward.create_data_loader(self, val_idxs))
+            feedforward.create_data_loader(
+                self, val_idxs, batch_size=self.eval_batch_size))
@@ -1,69 +1,289 @@
 """
 Config and functions to train and test feedforward networks using backprop
 """
+import functools
 import time
+import os
 from os.path import join
 import abc
-import torch.multiprocessing as mp
-import torch
-import torch.optim
-import torch.utils.data as TD
+from contextlib import contextmanager, nullcontext
 
 from .. import checkpointing
+from .. import freezing
+from ..lazy import torch
 
 
-def create_data_loader(config, idxs, shuffle=True):
-    if shuffle:
-        sampler = TD.SubsetRandomSampler(idxs)
+def create_data_loader(config, idxs, shuffle=True, num_workers=None,
+                       sampler=None, batch_size=None):
+    """Return a DataLoader over the given dataset indexes.  If a sampler is
+    given, it yields the dataset indexes instead, and idxs is ignored.
+    batch_size defaults to config.batch_size"""
+    if sampler is not None:
+        dataset = config.dataset
+    elif shuffle:
+        # a dataset may define how to randomly sample it efficiently
+        sampler = getattr(
+            config.dataset, 'random_sampler',
+            torch.utils.data.SubsetRandomSampler)(idxs)
         dataset = config.dataset
     else:
-        sampler = TD.SequentialSampler(idxs)
-        dataset = TD.Subset(config.dataset, idxs)
-    return TD.DataLoader(
+        sampler = torch.utils.data.SequentialSampler(idxs)
+        dataset = torch.utils.data.Subset(config.dataset, idxs)
+    worker_init_fn = None
+    if config._worker_cores:
+        from ..autotune import set_worker_affinity
+        worker_init_fn = functools.partial(
+            set_worker_affinity, config._worker_cores)
+    return torch.utils.data.DataLoader(
         dataset,
-        batch_size=config.batch_size,
+        worker_init_fn=worker_init_fn,
+        batch_size=batch_size or config.batch_size,
         sampler=sampler,
-        pin_memory=True, num_workers=config.data_loader_num_workers
+        # pinned memory only speeds up copies to a gpu
+        pin_memory=config.device.startswith('cuda'),
+        num_workers=config.data_loader_num_workers
+        if num_workers is None else num_workers
     )
 
 
+def device_batches(config, batches):
+    """Return an iterable of the (X, y) batches moved to config.device and to
+    the memory format of config.model.  Unless config.prefetch_batches is 0,
+    batches are loaded and moved ahead of use in a background thread."""
+    from ..prefetch import DevicePrefetcher, get_memory_format
+    if not config.prefetch_batches:
+        return ((X.to(config.device), y.to(config.device))
+                for X, y in batches)
+    return DevicePrefetcher(
+        batches, config.device, config.prefetch_batches,
+        get_memory_format(config.model))
+
+
+def cpu_supports_bf16():
+    """True if oneDNN has bfloat16 kernels for this cpu"""
+    return torch.backends.mkldnn.is_available() \
+        and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+
+
+def enable_cpu_performance_mode(config):
+    """Convert config.model to channels_last, which the oneDNN convolutions
+    prefer.  Batches follow the model's memory format (see device_batches),
+    and forward passes within autocast(config) use bfloat16 if enabled."""
+    config.model.to(memory_format=torch.channels_last)
+    print("cpu performance mode: channels_last, bfloat16 autocast %s"
+          % uses_bf16_autocast(config))
+
+
+def uses_bf16_autocast(config):
+    if not config.cpu_performance_mode or config.device != 'cpu':
+        return False
+    if config.cpu_autocast == 'auto':
+        return cpu_supports_bf16()
+    return config.cpu_autocast == 'bfloat16'
+
+
+def autocast(config):
+    """Context for the forward pass of training, validation and scoring.  In
+    cpu performance mode, autocast to bfloat16 if enabled"""
+    if uses_bf16_autocast(config):
+        return torch.autocast('cpu', dtype=torch.bfloat16)
+    return nullcontext()
+
+
+def preprocess_batch(config, X, train):
+    """Prepare a batch of images from a data loader for the model.
+    Apply the batch augmentation to training batches, if enabled."""
+    if config.batch_augmentation:
+        if train:
+            return config.batch_augmenter(X)
+        return X.float().div_(255)
+    return X
+
+
+def get_batches_and_model(config, data_loader, train):
+    """Return the (X, y) batches to iterate over, on config.device, and the
+    model to apply to X.
+
+    If config.feature_cache_views, X are cached backbone features of the
+    images the data loader would load, and the model is just the top layers.
+    Training batches use the augmented views of the cache, and validation
+    batches its deterministic eval view.
+    """
+    if config.feature_cache_views:
+        model = getattr(config.model, 'module', config.model)
+        return (device_batches(
+            config, config.feature_cache.iter_batches(data_loader, train)),
+            model.forward_head)
+    return device_batches(config, data_loader), get_forward_model(config)
+
+
+def get_forward_model(config):
+    """Return the model to call on batches of images: the inference model of
+    the current validation or scoring phase if there is one, else the compiled
+    model if config.compile_model, otherwise config.model."""
+    if config._inference_model is not None:
+        return config._inference_model
+    if config.compile_model:
+        return config.compiled_model
+    return config.model
+
+
+@contextmanager
+def inference_phase(config, model=None):
+    """Context for a no-grad validation or scoring pass.  Within the
+    context, get_forward_model returns an inference copy of the current model
+    if config.fold_inference_model or config.quantized_inference.  The copy
+    is made from the live training weights each time.
+
+    model - the module to copy, if not config.model.  It should share
+        parameters with config.model, ie a models.ScoringModel.
+    """
+    if config.feature_cache_views:
+        yield
+        return
+    if model is None:
+        model = getattr(config.model, 'module', config.model)
+    inference_model = None
+    if config.fold_inference_model:
+        from .. import folding
+        inference_model = model = folding.build_folded_model(model)
+    if config.quantized_inference and config.device != 'cpu':
+        print("Quantized inference requires device=cpu.  Using float model")
+    elif config.quantized_inference:
+        from .. import quantization
+        inference_model = quantization.build_quantized_model(config, model)
+    config._inference_model = inference_model
+    try:
+        yield
+    finally:
+        config._inference_model = None
+
+
+def read_metrics(pending, totloss, correct):
+    """Add the metrics of pending batches to the running totals and clear
+    pending.  pending is a list of (loss, num_correct, weight) per batch,
+    where loss and num_correct are device tensors.  They are read back to
+    the host at once, and totloss += loss * weight and correct += num_correct
+    are summed in batch order, so the totals equal those from calling .item()
+    on each batch."""
+    if pending:
+        losses = torch.stack([x[0] for x in pending]).tolist()
+        corrects = torch.stack([x[1] for x in pending]).tolist()
+        for _loss, _correct, (_, _, weight) in zip(losses, corrects, pending):
+            totloss += _loss * weight
+            correct += _correct
+        pending.clear()
+    return totloss, correct
+
+
 def train_one_epoch(config):
     config.model.train()
     _train_loss, _train_correct, N = 0, 0, 0
-    for batch_idx, (X, y) in enumerate(config.train_loader):
+    # metrics of each batch stay on the device until they are logged, so the
+    # loop doesn't wait for the device every batch.  See read_metrics
+    _pending = []
+    batches, model = get_batches_and_model(
+        config, config.train_loader, train=True)
+    # ie for loss prioritized replay, give the sampler each sample's loss
+    sampler = config.train_loader.sampler
+    track_losses = getattr(sampler, 'tracks_losses', False)
+    for batch_idx, (X, y) in enumerate(batches):
         #  if X.shape[0] != config.batch_size:
             #  print("Skipping end of batch", X.shape)
             #  continue
-        X, y = X.to(config.device), y.to(config.device)
+        if not config.feature_cache_views:
+            X = preprocess_batch(config, X, train=True)
         config.optimizer.zero_grad()
-        yhat = config.model(X)
-        loss = config.lossfn(yhat, y.float())
+        with autocast(config):
+            yhat = model(X)
+            loss = config.lossfn(yhat, y.float())
         loss.backward()
         config.optimizer.step()
+        if config._lr_scheduler is not None:
+            config._lr_scheduler.step()
 
         with torch.no_grad():
             batch_size = X.shape[0]
-            _loss = loss.item() * batch_size
-            _train_loss += _loss
-            _correct = y.int().eq((yhat.view_as(y) > .5).int()).sum().item()
-            _train_correct += _correct
+            if track_losses:
+                sampler.record_losses(config.per_sample_lossfn(
+                    yhat.float(), y.float()).view(batch_size, -1).mean(1))
+            config._num_imgs_processed += batch_size
+            _pending.append((
+                loss.detach(),
+                y.int().eq((yhat.view_as(y) > .5).int()).sum(),
+                batch_size))
             N += batch_size
 
             # log train performance of the batch every so often
             if batch_idx % config.log_msg_minibatch_interval \
                     == config.log_msg_minibatch_interval - 1:
+                _train_loss, _train_correct = read_metrics(
+                    _pending, _train_loss, _train_correct)
                 print(config.log_msg_minibatch.format(
                     train_loss=_train_loss/N, train_acc=_train_correct/N,
                     **locals()))
+    _train_loss, _train_correct = read_metrics(
+        _pending, _train_loss, _train_correct)
     return _train_loss/N, _train_correct/N
 
 
-def train(config):
+def parse_resolution_schedule(schedule):
+    """Parse a schedule like "1:256,10:384,20:512" into a sorted list of
+    (start, img_size) tuples"""
+    rv = []
+    for item in schedule.split(','):
+        start, img_size = item.split(':')
+        rv.append((int(start), int(img_size)))
+    return sorted(rv)
+
+
+def update_img_size(config, step):
+    """Apply the resolution schedule for the given epoch or al iter.
+    If the image size changes, replace the image transform of the dataset.
+    Data loader workers copy the dataset each time a loader is iterated, so
+    all later training, validation and scoring passes use the new size."""
+    img_size = config.img_size
+    for start, _img_size in parse_resolution_schedule(
+            config.resolution_schedule):
+        if step >= start:
+            img_size = _img_size
+    if img_size != config.cur_img_size:
+        print("set img_size: %s" % img_size)
+        config.cur_img_size = img_size
+        config.dataset.transform = config.get_img_transform()
+        if config._tuned_img_size and img_size > config._tuned_img_size:
+            print("WARNING: img_size %s is larger than the img_size %s the"
+                  " batch sizes were tuned for.  They may not fit in memory"
+                  % (img_size, config._tuned_img_size))
+
+
+def train(config, epochs=None, early_stopping_patience=None,
+          on_epoch_end=None):
+    """Train until the given epoch, by default config.epochs.
+    early_stopping_patience defaults to config.early_stopping_patience.
+    If given, call on_epoch_end(epoch) after each epoch"""
+    if epochs is None:
+        epochs = config.epochs
+    if early_stopping_patience is None:
+        early_stopping_patience = config.early_stopping_patience
     early_stopping_best_val_loss = float('inf')
     early_stopping_counter = 0
-    for epoch in range(config.cur_epoch + 1, config.epochs + 1):
+    for epoch in range(config.cur_epoch + 1, epochs + 1):
         config.cur_epoch = epoch
+        if config.resolution_schedule \
+                and config.resolution_schedule_unit == 'epoch':
+            update_img_size(config, epoch)
+        if config.freeze_schedule and config.freeze_schedule_unit == 'epoch':
+            freezing.update_frozen_layers(config, epoch)
+        _start_time = time.time()
         train_loss, train_acc = train_one_epoch(config)
+        train_seconds = time.time() - _start_time
+        if config.resolution_schedule:
+            print(config.log_msg_img_size.format(
+                train_imgs_per_sec=len(config.train_loader.sampler)
+                / train_seconds, **locals()))
+        if config.freeze_schedule:
+            print(config.log_msg_train_seconds.format(**locals()))
         if config.checkpoint_interval > 0\
                 and epoch % config.checkpoint_interval == 0:
             checkpointing.save_checkpoint(
@@ -75,15 +295,17 @@ def train(config):
             val_loss, val_acc = None, None
 
         print(config.log_msg_epoch.format(time=time.time(), **locals()))
+        if on_epoch_end is not None:
+            on_epoch_end(epoch)
 
         # early stopping
-        if val_loss is not None and config.early_stopping_patience > 0:
+        if val_loss is not None and early_stopping_patience > 0:
             if val_loss <= early_stopping_best_val_loss:
                 early_stopping_counter = 0
                 early_stopping_best_val_loss = val_loss
             else:
                 early_stopping_counter += 1
-                if early_stopping_counter + 1 > config.early_stopping_patience:
+                if early_stopping_counter + 1 > early_stopping_patience:
                     print("Early stopping")
                     break
 
@@ -95,14 +317,23 @@ def test(config):
     totloss = 0
     correct = 0
     N = 0
-    with torch.no_grad():
-        for X, y in config.val_loader:
+    _pending = []  # see read_metrics
+    with inference_phase(config), torch.no_grad():
+        batches, model = get_batches_and_model(
+            config, config.val_loader, train=False)
+        for X, y in batches:
             batch_size = X.shape[0]
-            X, y = X.to(config.device), y.to(config.device)
-            yhat = config.model(X)
-            totloss += (config.lossfn(yhat, y.float()) * batch_size).item()
-            correct += y.int().eq((yhat.view_as(y) > .5).int()).sum().item()
+            if not config.feature_cache_views:
+                X = preprocess_batch(config, X, train=False)
+            with autocast(config):
+                yhat = model(X)
+            yhat = yhat.float()
+            _pending.append((
+                config.lossfn(yhat, y.float()) * batch_size,
+                y.int().eq((yhat.view_as(y) > .5).int()).sum(),
+                1))
             N += batch_size
+    totloss, correct = read_metrics(_pending, totloss, correct)
     return totloss/N, correct/N
 
 
@@ -140,8 +371,51 @@ class FeedForwardModelConfig(abc.ABC):
     def train(self):
         return train(self)
 
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    def get_compiled_model(self):
+        return self.compile_module(self.model)
+
+    def compile_module(self, module):
+        """Compile the module with torch.compile.  The compiled module shares
+        parameters, train/eval mode and hooks with the given module.  Compiled
+        kernels are cached on disk, under base_dir when run from the
+        command-line (see cmdline.main), so later runs skip most of the
+        compile time."""
+        import torch._inductor.config
+        torch._inductor.config.fx_graph_cache = True
+        return torch.compile(module, mode=self.compile_mode)
+
+    def get_feature_cache(self):
+        from ..feature_cache import build_feature_cache
+        return build_feature_cache(self)
+
+    def get_img_transform(self, train=True):
+        """Return the per image transform of the dataset at resolution
+        self.cur_img_size, without random augmentation if not train.
+        Required to use a resolution_schedule or a feature cache"""
+        raise NotImplementedError("Your implementation here")
+
+    def get_batch_augmenter(self):
+        from ..augmentation import BatchAugmentation
+        return BatchAugmentation()
+
+    # batch sizes of validation and MedAL scoring passes.  0 for batch_size
+    eval_batch_size = 0
+    scoring_batch_size = 0
+    # on startup, choose batch_size, eval_batch_size and scoring_batch_size
+    # by measuring throughput of the candidate batch sizes that use at most
+    # memory_frac of the gpu memory, or of the ram on cpu.  Results are cached
+    # in a json file relative to base_dir.  See autotune.tune_batch_sizes
+    auto_batch_size = False
+    auto_batch_size_candidates = '4,8,16,32,64,128,256'
+    auto_batch_size_memory_frac = 0.9
+    auto_batch_size_cache = 'batch_size_cache.json'
+    _tuned_img_size = 0
+
+    device = ''  # empty for cuda if available, otherwise cpu
     checkpoint_interval = 1  # save checkpoint during training every N epochs
+    # keys of get_checkpoint_extra_state that checkpoints saved by older
+    # versions don't have.  If missing, they keep their default
+    _checkpoint_optional_keys = ('_num_imgs_processed', )
     checkpoint_fname = "{config.run_id}/epoch_{config.cur_epoch}.pth"
 
     val_perf_interval = 1  # compute validation acc/loss after every N epochs
@@ -151,10 +425,87 @@ class FeedForwardModelConfig(abc.ABC):
     # the epoch number is actually 1 indexed.  By default, try to load the
     # epoch 0 file, which won't exist unless you manually put it there.
     cur_epoch = 0
+    _num_imgs_processed = 0  # num training images seen, over all restarts
 
     early_stopping_patience = 0  # early stopping, disabled by default
-
-    data_loader_num_workers = max(1, mp.cpu_count() - 1)
+    _lr_scheduler = None  # if set, stepped after every optimizer step
+
+    # augment whole batches with tensor ops after collation, instead of each
+    # image in the data loader workers.
+    batch_augmentation = False
+
+    # progressive resolution.  Comma separated "start:img_size" pairs, where
+    # start is an epoch or al iter.  ie "1:256,3:384,5:512" uses 256px images
+    # from the first epoch, 384px from the 3rd and 512px from the 5th.
+    # Applies to training, validation and scoring.  If empty, use img_size.
+    img_size = 512
+    resolution_schedule = ''
+    resolution_schedule_unit = 'epoch'  # or 'al_iter'
+
+    # freeze layers of the model, so they cost no backward pass or optimizer
+    # update.  Comma separated "start:layers" pairs, where start is an epoch
+    # or al iter and layers are "+" separated submodule names.  With unit
+    # epoch, MedAL restarts the schedule each al iter, unfreezing the layers
+    # again.  ie with unit al_iter, "2:resnet18_layers.conv1+
+    # resnet18_layers.bn1+resnet18_layers.layer1" freezes the stem and first
+    # block after the first al iter.  BatchNorm stats of frozen layers still
+    # update in training mode.
+    freeze_schedule = ''
+    freeze_schedule_unit = 'epoch'  # or 'al_iter'
+    _frozen_layer_names = []
+    _frozen_params = []  # the parameters freezing.update_frozen_layers froze
+
+    # train and evaluate only the top layers from cached backbone features.
+    # The backbone must be frozen.  Cache N (augmented) views per image, plus
+    # one view without augmentation for validation, or 0 to disable.  If
+    # feature_cache_dir is set, keep the cache on disk there.
+    feature_cache_views = 0
+    feature_cache_dir = ''
+
+    # run training, validation and scoring passes with a compiled model.
+    # mode is passed to torch.compile, ie "default" or "reduce-overhead"
+    compile_model = False
+    compile_mode = 'default'
+
+    # run validation and scoring passes on cpu with an int8 quantized copy of
+    # the model, made at the start of each pass.  "dynamic", "static" (with
+    # calibration on a few labeled batches) or empty to disable.  The gap to
+    # the float model on the calibration batches is logged each time.
+    quantized_inference = ''
+    quantization_calibration_batches = 4
+    # run validation and scoring passes with a copy of the model that has
+    # BatchNorm and input normalization folded into the convolutions
+    fold_inference_model = False
+    _inference_model = None  # set within inference_phase
+
+    # on cpu, run the model and batches in channels_last memory format.
+    # cpu_autocast is "bfloat16", "auto" (bfloat16 if the
+    # cpu supports it) or "" to stay in float32
+    cpu_performance_mode = False
+    cpu_autocast = 'auto'
+
+    # save memory when training by splitting the backbone (inception_layers
+    # or resnet18_layers) into N segments, and only keeping the activations
+    # at segment boundaries.  The rest are recomputed during backward.  0 to
+    # disable.  The recomputed forward doesn't update BatchNorm running stats
+    # again.  See models.activation_checkpointing
+    activation_checkpoint_segments = 0
+
+    data_loader_num_workers = max(1, os.cpu_count() - 1)
+    # split a budget of N cpu cores between data loader workers and torch's
+    # intra-op threads.  0 to use all cores this process may use.  With
+    # auto_resource_plan, measure a few candidate splits on
+    # resource_plan_calibration_batches batches.  See autotune.plan_resources
+    cpu_budget = 0
+    # use the cpu_budget cores starting at this index of the affinity mask.
+    # Give jobs that share a machine disjoint ranges of cores
+    cpu_offset = 0
+    auto_resource_plan = False
+    resource_plan_calibration_batches = 4
+    worker_cpu_affinity = False  # pin each worker to its own core
+    _worker_cores = None
+    # num batches to load and move to the device ahead of use.  0 to disable
+    prefetch_batches = 2
     log_msg_epoch = (
         "epoch {config.cur_epoch} "
         "train_loss {train_loss} val_loss {val_loss} "
@@ -162,6 +513,31 @@ class FeedForwardModelConfig(abc.ABC):
     log_msg_minibatch = (
         "--> epoch {config.cur_epoch} batch_idx {batch_idx} "
         "train_loss {train_loss} train_acc {train_acc}")
+    log_msg_img_size = (
+        "img_size {config.cur_img_size} "
+        "train_imgs_per_sec {train_imgs_per_sec}")
+    log_msg_freeze = (
+        "frozen_layers {frozen_layers} num_frozen_params {num_frozen_params} "
+        "backward_flops_saved_frac {backward_flops_saved_frac}")
+    log_msg_train_seconds = (
+        "epoch {config.cur_epoch} train_seconds {train_seconds}")
+    log_msg_resource_plan = (
+        "cpu_budget {cpu_budget} data_loader_num_workers {num_workers} "
+        "intra_op_threads {num_threads} "
+        "inter_op_threads {num_interop_threads} "
+        "worker_cpu_affinity {config.worker_cpu_affinity}")
+    log_msg_resource_calibration = (
+        "calibrate data_loader_num_workers {num_workers} "
+        "intra_op_threads {num_threads} "
+        "load_imgs_per_sec {load_imgs_per_sec} "
+        "train_imgs_per_sec {train_imgs_per_sec}")
+    log_msg_batch_size_tuning = (
+        "tune {phase} batch_size {batch_size} imgs_per_sec {imgs_per_sec} "
+        "peak_memory {peak_memory}")
+    log_msg_quantization_gap = (
+        "quantized {config.quantized_inference} num_imgs {num_imgs} "
+        "prob_gap {prob_gap} entropy_gap {entropy_gap} "
+        "pred_agreement {pred_agreement}")
 
     def __init__(self, config_override_dict):
         self.__dict__.update({k: v for k, v in config_override_dict.items()
@@ -169,12 +545,37 @@ class FeedForwardModelConfig(abc.ABC):
         assert isinstance(self.run_id, str), "must define a run_id to identify the model, ie via --run-id mytestrun"
         self.checkpoint_dir = join(self.base_dir, 'model_checkpoints')
         self.torch_model_dir = join(self.base_dir, 'torch/models')
+        self.cur_img_size = self.img_size
+
+    # These attributes are expensive to create, so they are created on first
+    # access by calling the given method.
+    _lazy_attributes = {
+        'model': 'get_model',
+        'lossfn': 'get_lossfn',
+        'optimizer': 'get_optimizer',
+        'dataset': 'get_dataset',
+        'batch_augmenter': 'get_batch_augmenter',
+        'feature_cache': 'get_feature_cache',
+        'per_sample_lossfn': '_get_per_sample_lossfn',
+        'compiled_model': 'get_compiled_model',
+    }
+
+    def __getattr__(self, name):
+        # only called if the attribute was not found the normal way
+        if name in ('train_loader', 'val_loader'):
+            # create both at once so they share one train/val split
+            self.train_loader, self.val_loader = self.get_data_loaders()
+        elif name in self._lazy_attributes:
+            setattr(self, name, getattr(self, self._lazy_attributes[name])())
+        else:
+            raise AttributeError(
+                "%s has no attribute %r" % (type(self).__name__, name))
+        return self.__dict__[name]
 
-        self.model = self.get_model()
-        self.lossfn = self.get_lossfn()
-        self.optimizer = self.get_optimizer()
-        self.dataset = self.get_dataset()
-        self.train_loader, self.val_loader = self.get_data_loaders()
+    def _get_per_sample_lossfn(self):
+        lossfn = self.get_lossfn()
+        lossfn.reduction = 'none'
+        return lossfn
 
     def __repr__(self):
         return "config:%s" % self.run_id
@@ -186,4 +587,5 @@ class FeedForwardModelConfig(abc.ABC):
         """Extra state to save in the checkpoint file.  The key name should
         exactly match the variable name so restore checkpoint can load it
         correctly."""
-        return {'cur_epoch': self.cur_epoch}
+        return {'cur_epoch': self.cur_epoch,
+                '_num_imgs_processed': self._num_imgs_processed}
@@ -1,12 +1,15 @@
-import abc
+import math
+import numpy as np
 import pickle
-import torch
-from contextlib import contextmanager
+import time
+import traceback
 
 from .baseline_inception import BaselineInceptionV3BinaryClassifier
 from .baseline_squeezenet import BaselineSqueezeNetBinaryClassifier
 from .baseline_resnet18 import BaselineResnet18BinaryClassifier
 from . import feedforward
+from .. import freezing
+from ..lazy import torch
 
 
 def pick_initial_data_points_to_label(config):
@@ -26,21 +29,41 @@ def pick_data_points_to_label(config):
     if unlabeled_idxs.shape[0] <= config.num_points_to_label_per_al_iter:
         return unlabeled_idxs
 
+    if config.diversity_selection == 'kcenter':
+        return select_kcenter_greedy(
+            embedding_labeled, embedding_unlabeled, unlabeled_idxs,
+            config.num_points_to_label_per_al_iter,
+            num_clusters=config.kcenter_num_clusters,
+            time_budget=config.kcenter_time_budget)
+    elif config.diversity_selection == 'centroid':
+        return select_farthest_from_centroid(
+            embedding_labeled, embedding_unlabeled, unlabeled_idxs,
+            config.num_points_to_label_per_al_iter)
+    raise ValueError(
+        "Unrecognized diversity_selection: %s" % config.diversity_selection)
+
+
+def select_farthest_from_centroid(embedding_labeled, embedding_unlabeled,
+                                  unlabeled_idxs, num_points_to_label):
+    """The MedAL diversity selection.  Pick unlabeled points one at a time,
+    each time choosing the point farthest from the centroid of the labeled
+    and already picked points.  Return the chosen values of unlabeled_idxs.
+    """
+    device = embedding_unlabeled.device
     # centroid of labeled data in euclidean space is the average of all points.
     # but for computational efficiency, maintain two sets and take weighted
     # average.
     N = embedding_labeled.shape[0]  # num previously labeled items
     M = 0  # num newly labeled items
     old_items_centroid = embedding_labeled.mean(0)  # fixed
-    new_items_sum = torch.zeros_like(old_items_centroid, device=config.device)
+    new_items_sum = torch.zeros_like(old_items_centroid, device=device)
     remaining_unpicked_items = torch.ones(
-        embedding_unlabeled.shape[0], dtype=torch.bool).to(config.device)
+        embedding_unlabeled.shape[0], dtype=torch.bool).to(device)
     points_to_label = torch.empty(
-        config.num_points_to_label_per_al_iter,
-        dtype=torch.long, device=config.device)
+        num_points_to_label, dtype=torch.long, device=device)
 
     # pick unlabeled points, one at a time.  update centroid each time.
-    for n in range(config.num_points_to_label_per_al_iter):
+    for n in range(num_points_to_label):
         centroid = N/(N+M)*old_items_centroid + 1/(N+M)*new_items_sum
 
         unlabeled_items = embedding_unlabeled[remaining_unpicked_items]
@@ -55,18 +78,111 @@ def pick_data_points_to_label(config):
         # --> update the list of remaining unpicked items.
         # This is complicated because r[r][chosen_point] = 0 doesn't work :(
         _tmp = torch.arange(
-            remaining_unpicked_items.shape[0], device=config.device)
+            remaining_unpicked_items.shape[0], device=device)
         _tmp2 = _tmp[remaining_unpicked_items][chosen_point]
         assert remaining_unpicked_items[_tmp2] == 1
         remaining_unpicked_items[_tmp2] = 0
         assert remaining_unpicked_items[_tmp2] == 0
 
-    assert (~remaining_unpicked_items).sum() \
-        == config.num_points_to_label_per_al_iter
+    assert (~remaining_unpicked_items).sum() == num_points_to_label
 
     return points_to_label
 
 
+def select_kcenter_greedy(embedding_labeled, embedding_unlabeled,
+                          unlabeled_idxs, num_points_to_label,
+                          num_clusters=0, chunk_size=4096, time_budget=0):
+    """Diversity selection by k-center greedy.  Keep the distance from each
+    unlabeled point to its nearest labeled or picked point, and repeatedly
+    pick the point farthest from all of them.  Costs O(N*(L+k)) for N
+    unlabeled, L labeled and k picked points.
+
+    num_clusters - If more than 0 and less than N, first cluster the unlabeled
+    points with minibatch k-means and only consider the point nearest to each
+    cluster center.  This bounds the cost for very large candidate sets.
+    time_budget - If more than 0, the seconds k-means and the greedy picks
+    may take.  When they run out, k-means stops early, and the remaining
+    points are picked in one step, by their distance to the labeled and
+    already picked points.
+
+    Return the chosen values of unlabeled_idxs.
+    """
+    deadline = time.time() + time_budget if time_budget else None
+    candidates = torch.arange(
+        embedding_unlabeled.shape[0], device=embedding_unlabeled.device)
+    if 0 < num_clusters < embedding_unlabeled.shape[0] \
+            and num_clusters > num_points_to_label:
+        representatives = kmeans_representatives(
+            embedding_unlabeled, num_clusters, deadline=deadline)
+        if representatives.shape[0] >= num_points_to_label:
+            candidates = representatives
+    X = embedding_unlabeled[candidates]
+
+    # distance from each candidate to its nearest labeled point.  Chunk both
+    # sets, so the distance matrices are at most chunk_size x chunk_size
+    min_dists = torch.full(
+        (X.shape[0], ), float('inf'), device=X.device, dtype=X.dtype)
+    for start in range(0, X.shape[0], chunk_size):
+        _X = X[start:start + chunk_size]
+        for chunk in embedding_labeled.split(chunk_size):
+            min_dists[start:start + chunk_size] = torch.min(
+                min_dists[start:start + chunk_size],
+                torch.cdist(_X, chunk).min(1)[0])
+
+    picked = torch.empty(
+        num_points_to_label, dtype=torch.long, device=X.device)
+    for n in range(num_points_to_label):
+        if deadline is not None and time.time() > deadline:
+            print("kcenter_time_budget exceeded after %s of %s picks"
+                  % (n, num_points_to_label))
+            picked[n:] = torch.topk(min_dists, num_points_to_label - n)[1]
+            break
+        chosen_point = min_dists.argmax()
+        picked[n] = chosen_point
+        min_dists = torch.min(
+            min_dists, torch.norm(X - X[chosen_point], p=2, dim=1))
+        min_dists[chosen_point] = -1  # never pick a point twice
+    return unlabeled_idxs[candidates[picked]]
+
+
+def kmeans_representatives(X, num_clusters, random_state=None,
+                           max_iter=20, deadline=None):
+    """Cluster the rows of X with minibatch k-means, and return the row index
+    of the point nearest each cluster center.
+
+    Runs max_iter passes over X, but stops after the first minibatch past
+    the deadline, a time.time() value, if given."""
+    from sklearn.cluster import MiniBatchKMeans
+    batch_size = max(1024, 3 * num_clusters)
+    km = MiniBatchKMeans(
+        n_clusters=num_clusters, batch_size=batch_size,
+        n_init=1, random_state=random_state)
+    _X = X.cpu().numpy()
+    rng = np.random.RandomState(random_state)
+    num_batches = math.ceil(_X.shape[0] / batch_size)
+    for step in range(max_iter * num_batches):
+        start = step % num_batches * batch_size
+        if start == 0:
+            perm = rng.permutation(_X.shape[0])
+        km.partial_fit(_X[perm[start:start + batch_size]])
+        if deadline is not None and time.time() > deadline:
+            print("kcenter_time_budget exceeded after %s k-means minibatches"
+                  % (step + 1))
+            break
+    centers = torch.tensor(km.cluster_centers_, dtype=X.dtype, device=X.device)
+    nearest_dist = torch.full(
+        (centers.shape[0], ), float('inf'), dtype=X.dtype, device=X.device)
+    nearest = torch.zeros(centers.shape[0], dtype=torch.long, device=X.device)
+    offset = 0
+    for chunk in X.split(4096):
+        dist, idx = torch.cdist(centers, chunk).min(1)
+        closer = dist < nearest_dist
+        nearest_dist[closer] = dist[closer]
+        nearest[closer] = idx[closer] + offset
+        offset += chunk.shape[0]
+    return torch.unique(nearest)
+
+
 def get_labeled_and_topk_unlabeled_embeddings(config):
     """Return a tuple of (
         labeled training data embeddings,
@@ -75,22 +191,117 @@ def get_labeled_and_topk_unlabeled_embeddings(config):
     )
     The unlabeled index is an index over the unlabeled config._train_indices
     """
-    # get model prediction on unlabeled points
-    unlabeled_data_loader = feedforward.create_data_loader(
-        config, idxs=config._train_indices[~config._is_labeled].cpu().numpy(), shuffle=False)
-    labeled_data_loader = feedforward.create_data_loader(
-        config, idxs=config._train_indices[config._is_labeled].cpu().numpy(), shuffle=False)
-
-    # get unlabeled data embeddings on the N highest predictive entropy samples
-    embedding_unlabeled, unlabeled_idxs = get_feature_embedding(
-        config, unlabeled_data_loader, topk=config.num_max_entropy_samples)
-    # get labeled data embeddings
-    embedding_labeled, _ = get_feature_embedding(
-        config, labeled_data_loader, topk=None)
+    with feedforward.inference_phase(config, config.scoring_model):
+        return _get_labeled_and_topk_unlabeled_embeddings(config)
+
+
+def _get_labeled_and_topk_unlabeled_embeddings(config):
+    # dataset indexes of all unlabeled and labeled points
+    unlabeled_idxs = config._train_indices[~config._is_labeled].cpu().numpy()
+    labeled_idxs = config._train_indices[config._is_labeled].cpu().numpy()
+
+    # only score the most uncertain items according to a cheap proxy.
+    # candidate_pos are their positions in unlabeled_idxs
+    candidate_idxs = unlabeled_idxs
+    if config.proxy_scoring_img_size:
+        _start_time = time.time()
+        candidate_pos = get_proxy_scoring_candidates(config, unlabeled_idxs)
+        candidate_idxs = unlabeled_idxs[candidate_pos.cpu().numpy()]
+        proxy_scoring_time = time.time() - _start_time
+    _start_time = time.time()
+
+    # topk_pos are the positions in candidate_idxs of the N highest
+    # predictive entropy samples
+    if config.scoring_num_processes > 1 and config.device == 'cpu':
+        embedding_unlabeled, topk_pos = get_feature_embedding_sharded(
+            config, candidate_idxs, topk=config.num_max_entropy_samples)
+        embedding_labeled, _ = get_feature_embedding_sharded(
+            config, labeled_idxs, topk=None)
+    else:
+        if config.scoring_num_processes > 1:
+            print("Sharded scoring requires device=cpu.  Using one process")
+        # get model prediction on unlabeled points
+        unlabeled_data_loader = feedforward.create_data_loader(
+            config, idxs=candidate_idxs, shuffle=False,
+            batch_size=config.scoring_batch_size)
+        labeled_data_loader = feedforward.create_data_loader(
+            config, idxs=labeled_idxs, shuffle=False,
+            batch_size=config.scoring_batch_size)
+
+        # get unlabeled data embeddings on the N highest predictive entropy
+        # samples
+        embedding_unlabeled, topk_pos = get_feature_embedding(
+            config, unlabeled_data_loader, topk=config.num_max_entropy_samples)
+        # get labeled data embeddings
+        embedding_labeled, _ = get_feature_embedding(
+            config, labeled_data_loader, topk=None)
+
+    if config.proxy_scoring_img_size:
+        # make topk_pos an index over all unlabeled points again
+        topk_pos = candidate_pos[topk_pos]
+        print(config.log_msg_scoring_time.format(
+            scoring_time=time.time() - _start_time, **locals()))
 
     assert embedding_unlabeled.shape[0] \
-        == unlabeled_idxs.shape[0]  # sanity check
-    return embedding_labeled, embedding_unlabeled, unlabeled_idxs
+        == topk_pos.shape[0]  # sanity check
+    return embedding_labeled, embedding_unlabeled, topk_pos
+
+
+def get_scoring_model(config):
+    """Return the model scoring passes call on a batch of images to get
+    (pooled_embedding, probability).  Either the quantized scoring model of
+    the current scoring pass, the compiled scoring model if
+    config.compile_model, or config.scoring_model.  All share parameters."""
+    if config._inference_model is not None:
+        return config._inference_model
+    if config.compile_model:
+        return config.compiled_scoring_model
+    return config.scoring_model
+
+
+def binary_entropy(yhat):
+    """Return the entropy of each predicted probability in yhat"""
+    _entropy = -yhat*torch.log2(yhat) - (1-yhat)*torch.log2(1-yhat)
+    # Work around when yhat == 1 and entropy is nan instead of 0
+    _m = torch.isnan(_entropy)
+    _entropy[_m] = 0
+    # check for other unexplained nan bugs
+    assert ((yhat[_m] == 1) | (yhat[_m] == 0)).all()
+    return _entropy
+
+
+def get_proxy_scoring_candidates(config, idxs):
+    """Cheaply score the given dataset indexes with the current model applied
+    to images loaded at config.proxy_scoring_img_size.
+
+    Return the positions in idxs of the highest entropy items.  Keep a
+    fraction config.proxy_scoring_keep_frac of the items, but at least
+    config.num_max_entropy_samples of them.
+    """
+    data_loader = feedforward.create_data_loader(
+        config, idxs, shuffle=False, batch_size=config.scoring_batch_size)
+    config.model.eval()
+    entropy = torch.tensor([]).to(config.device)
+    # decode and transform the images at the proxy size in the loader
+    img_size, transform = config.cur_img_size, config.dataset.transform
+    config.cur_img_size = config.proxy_scoring_img_size
+    config.dataset.transform = config.get_img_transform()
+    try:
+        with torch.no_grad():
+            for X, y in feedforward.device_batches(config, data_loader):
+                X = feedforward.preprocess_batch(config, X, train=False)
+                with feedforward.autocast(config):
+                    _, yhat = get_scoring_model(config)(X)
+                yhat = yhat.float()
+                entropy = torch.cat([entropy, binary_entropy(yhat).view(-1)])
+    finally:
+        config.cur_img_size, config.dataset.transform = img_size, transform
+    k = max(config.num_max_entropy_samples,
+            int(len(entropy) * config.proxy_scoring_keep_frac))
+    if k >= len(entropy):
+        return torch.arange(len(entropy), device=config.device)
+    # sorted, so the main scoring pass reads the dataset in order
+    return torch.topk(entropy, k)[1].sort()[0]
 
 
 def get_feature_embedding(config, data_loader, topk):
@@ -106,32 +317,35 @@ def get_feature_embedding(config, data_loader, topk):
     - Only 1 forward pass to get entropy and feature embedding
     - Done in a streaming fashion to be ram conscious
     """
+    embeddings, loader_idxs, _ = _get_feature_embedding(
+        config, data_loader, topk)
+    return embeddings, loader_idxs
+
+
+def _get_feature_embedding(config, data_loader, topk):
+    """Implements get_feature_embedding, but also return the entropy of each
+    returned item, or an empty tensor if topk is None"""
     config.model.eval()
-    _batched_embeddings = []
-    with torch.no_grad(), register_embedding_hook(
-            config.get_feature_embedding_layer(), _batched_embeddings):
+    model = get_scoring_model(config)
+    with torch.no_grad():
         entropy = torch.tensor([]).to(config.device)
         embeddings = torch.tensor([]).to(config.device)
         loader_idxs = torch.tensor([], dtype=torch.long).to(config.device)
         N = 0
-        for X, y in data_loader:
+        for X, y in feedforward.device_batches(config, data_loader):
             # get entropy and embeddings for this batch
-            X, y = X.to(config.device), y.to(config.device)
-            yhat = config.model(X)
+            X = feedforward.preprocess_batch(config, X, train=False)
+            with feedforward.autocast(config):
+                _embeddings, yhat = model(X)
+            _embeddings, yhat = _embeddings.float(), yhat.float()
             assert torch.isnan(yhat).sum() == 0
-            embeddings = torch.cat([embeddings, _batched_embeddings.pop()])
-            assert len(_batched_embeddings) == 0  # sanity check forward hook
+            embeddings = torch.cat([embeddings, _embeddings])
             loader_idxs = torch.cat([
                 loader_idxs,
                 torch.arange(N, N+X.shape[0], device=config.device)])
             # select only top k values
             if topk is not None:
-                _entropy = -yhat*torch.log2(yhat) - (1-yhat)*torch.log2(1-yhat)
-                # Work around when yhat == 1 and entropy is nan instead of 0
-                _m = torch.isnan(_entropy)
-                _entropy[_m] = 0
-                # check for other unexplained nan bugs
-                assert ((yhat[_m] == 1) | (yhat[_m] == 0)).all()
+                _entropy = binary_entropy(yhat)
                 entropy = torch.cat([entropy, _entropy])
                 assert torch.isnan(entropy).sum() == 0
                 assert len(entropy) == len(embeddings)
@@ -149,26 +363,159 @@ def get_feature_embedding(config, data_loader, topk):
             N += X.shape[0]
 
         embeddings = embeddings.reshape(embeddings.shape[0], -1)
-        return embeddings, loader_idxs
+        return embeddings, loader_idxs, entropy
+
+
+# The config used by forked scoring processes.  Set only while a pool of
+# scoring processes exists, so children inherit it rather than unpickle it.
+_sharded_scoring_config = None
 
 
-@contextmanager
-def register_embedding_hook(layer, output_arr):
+def _score_shard(shard):
+    """Score one shard of the dataset in a forked scoring process.  Return the
+    shard's local top k, with loader indexes offset to be over all shards.
+
+    Runs with one intra-op thread.  The OpenMP thread pool the parent
+    started isn't usable after fork, and using it from a forked child can
+    hang (ie with libgomp), so the processes replace the threads.
     """
-    Temporarily add a hook to a pytorch layer to capture output of that layer
-    on forward pass
-
-        >>> myemptylist = []
-        >>> layer = next(model.children())  # pick any layer from the model
-        >>> with register_embedding_hook(layer, myemptylist):
-        >>>     model(X)
-        >>> # now myemptylist is populated with output of given layer
+    torch.set_num_threads(1)
+    offset, idxs, topk = shard
+    config = _sharded_scoring_config
+    # daemonic pool processes cannot have data loader worker processes
+    data_loader = feedforward.create_data_loader(
+        config, idxs, shuffle=False, num_workers=0,
+        batch_size=config.scoring_batch_size)
+    embeddings, loader_idxs, entropy = _get_feature_embedding(
+        config, data_loader, topk)
+    return embeddings, loader_idxs + offset, entropy
+
+
+def get_feature_embedding_sharded(config, idxs, topk):
+    """Same as get_feature_embedding, but split the given dataset indexes
+    into contiguous shards and score each shard in its own process.
+
+    The forked processes read the current model weights copy-on-write, so
+    the weights are not copied or moved, and this process waits for them.
+    Each process keeps its own top k highest entropy items, using one
+    intra-op thread (see _score_shard).  The local top k lists are then
+    merged into the global top k.  The returned loader indexes are over the
+    given idxs, as if they were passed to one sequential data loader.
+
+    Only works on cpu, since the scoring processes are forked.
     """
-    handle = layer.register_forward_hook(
-        lambda thelayer, inpt, output: output_arr.append(output)
-    )
-    yield
-    handle.remove()
+    global _sharded_scoring_config
+    num_processes = min(config.scoring_num_processes, max(1, len(idxs)))
+    bounds = [len(idxs) * i // num_processes
+              for i in range(num_processes + 1)]
+    shards = [(start, idxs[start:stop], topk)
+              for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    _sharded_scoring_config = config
+    try:
+        with torch.multiprocessing.get_context('fork').Pool(
+                num_processes) as pool:
+            results = pool.map(_score_shard, shards)
+    finally:
+        _sharded_scoring_config = None
+
+    embeddings = torch.cat([x[0] for x in results])
+    loader_idxs = torch.cat([x[1] for x in results])
+    if topk is not None and len(loader_idxs) > topk:
+        # merge the local top k of each shard
+        entropy = torch.cat([x[2] for x in results])
+        _, idxs = torch.topk(entropy.view(-1), topk, dim=0)
+        embeddings = embeddings[idxs]
+        loader_idxs = loader_idxs[idxs]
+    return embeddings, loader_idxs
+
+
+def get_warm_start_epochs(config, num_newly_labeled):
+    """Return the epoch budget of an al iter in warm start mode: config.epochs
+    scaled by the fraction of the labeled points that are newly labeled,
+    clipped to [config.warm_start_min_epochs, config.epochs].  Then the
+    images processed per al iter stay proportional to the num newly labeled
+    points, instead of growing with the labeled set."""
+    num_labeled = int(config._is_labeled.sum())
+    epochs = math.ceil(config.epochs * num_newly_labeled / num_labeled)
+    return max(min(epochs, config.epochs), config.warm_start_min_epochs)
+
+
+def get_lr_warmup_scheduler(config):
+    """Return a scheduler that linearly increases the learning rate of
+    config.optimizer to its initial value over the first
+    config.warm_start_lr_warmup_batches optimizer steps"""
+    return torch.optim.lr_scheduler.LambdaLR(
+        config.optimizer, lambda step: min(
+            1, (step + 1) / config.warm_start_lr_warmup_batches))
+
+
+def _pipelined_pick(config, num_processes, conn):
+    """Run in the process PipelinedPick forks.  Send the points to label, or
+    the traceback of an error.
+
+    Like _score_shard, use one intra-op thread, since the parent's OpenMP
+    thread pool can hang after fork.  Score in num_processes sharded
+    scoring processes instead, if more than one."""
+    try:
+        torch.set_num_threads(1)
+        config.scoring_num_processes = num_processes
+        conn.send(pick_data_points_to_label(config).tolist())
+    except BaseException:
+        conn.send(traceback.format_exc())
+    finally:
+        conn.close()
+
+
+class PipelinedPick:
+    """Run pick_data_points_to_label(config) in a forked process with a
+    snapshot of the current model weights, while this process keeps
+    training.  Call result() to wait for the points to label.  The forked
+    process sees the weights copy-on-write, as they were at fork time, so
+    the snapshot costs no copy.
+
+    The cores are split between training and scoring until then: the
+    forked process scores with config.pipelined_scoring_num_processes single
+    threaded processes, and this process gives up as many intra-op threads.
+    Only works on cpu, since the process is forked.
+    """
+    def __init__(self, config):
+        self._device = config.device
+        self._start_time = time.time()
+        self._num_threads = torch.get_num_threads()
+        num_processes = config.pipelined_scoring_num_processes \
+            or max(1, self._num_threads // 2)
+        ctx = torch.multiprocessing.get_context('fork')
+        self._conn, child_conn = ctx.Pipe(duplex=False)
+        self._process = ctx.Process(
+            target=_pipelined_pick,
+            args=(config, num_processes, child_conn))
+        self._process.start()
+        child_conn.close()
+        torch.set_num_threads(max(1, self._num_threads - num_processes))
+
+    def result(self):
+        """Wait for and return the indexes of the points to label"""
+        _wait_start_time = time.time()
+        try:
+            rv = self._conn.recv()
+        except EOFError:
+            rv = None
+        self._process.join()
+        if rv is None:
+            rv = "Scoring process exited with code %s" \
+                % self._process.exitcode
+        torch.set_num_threads(self._num_threads)
+        if isinstance(rv, str):
+            raise RuntimeError("Pipelined scoring failed:\n%s" % rv)
+        print("pipelined_scoring_time %s pipelined_scoring_wait %s" % (
+            time.time() - self._start_time, time.time() - _wait_start_time))
+        return torch.tensor(rv, dtype=torch.long, device=self._device)
+
+    def cancel(self):
+        self._process.terminate()
+        self._process.join()
+        torch.set_num_threads(self._num_threads)
 
 
 def train(config):
@@ -177,9 +524,15 @@ def train(config):
     # set cur_al_iter and cur_epoch appropriately
     start_al_iter = config.cur_al_iter
     reset_cur_epoch = False
-    if config.cur_al_iter == 0 or config.cur_epoch == config.epochs:
+    if config.cur_al_iter == 0 or config.cur_epoch == config._al_iter_epochs:
         start_al_iter += 1
         reset_cur_epoch = True
+    pipelined = config.pipelined_scoring
+    if pipelined and config.device != 'cpu':
+        print("Pipelined scoring requires device=cpu.  Scoring in sequence")
+        pipelined = False
+    pending_pick = None  # a PipelinedPick of the next points to label
+
     for al_iter in range(start_al_iter, config.al_iters + 1):
         # update state for new al iteration
         if reset_cur_epoch:
@@ -187,24 +540,61 @@ def train(config):
             reset_cur_epoch = True
         config.cur_al_iter = al_iter
 
+        if config.resolution_schedule \
+                and config.resolution_schedule_unit == 'al_iter':
+            feedforward.update_img_size(config, al_iter)
+        if config.freeze_schedule \
+                and config.freeze_schedule_unit == 'al_iter':
+            freezing.update_frozen_layers(config, al_iter)
+
         # pick unlabeled points to label and label them
         if al_iter == 1:
             points_to_label = pick_initial_data_points_to_label(config)
+        elif pending_pick is not None:
+            points_to_label = pending_pick.result()
+            pending_pick = None
         else:
             points_to_label = pick_data_points_to_label(config)
 
         # reset_model weights if necessary
-        if config.reset_model_weights_each_al_iter:
+        if config.reset_model_weights_each_al_iter and not config.warm_start:
             config.model.load_state_dict(
                 pickle.loads(config._serialized_model_state_dict))
 
         # train model
         config.update_train_loader(points_to_label)
-        feedforward.train(config)  # train for many epochs
+        early_stopping_patience = config.early_stopping_patience
+        if config.warm_start:
+            config._al_iter_epochs = get_warm_start_epochs(
+                config, len(points_to_label))
+            if early_stopping_patience > 0:
+                early_stopping_patience = max(1, round(
+                    early_stopping_patience * config._al_iter_epochs
+                    / config.epochs))
+            if config.warm_start_lr_warmup_batches:
+                config._lr_scheduler = get_lr_warmup_scheduler(config)
+
+        # in pipelined mode, start picking the next points to label partway
+        # through training.  If training stops early, pick them afterwards.
+        snapshot_epoch = None
+        if pipelined and al_iter < config.al_iters:
+            snapshot_epoch = max(1, math.ceil(
+                config.pipelined_snapshot_frac * config._al_iter_epochs))
+
+        def start_pipelined_pick(epoch):
+            nonlocal pending_pick
+            if epoch == snapshot_epoch:
+                pending_pick = PipelinedPick(config)
+        feedforward.train(  # train for many epochs
+            config, config._al_iter_epochs, early_stopping_patience,
+            on_epoch_end=start_pipelined_pick if snapshot_epoch else None)
+        print(config.log_msg_al_iter.format(config=config))
 
         if config._is_labeled.sum() == config._is_labeled.shape[0]:
             print("Stop training.  Used up all available training data")
             break
+    if pending_pick is not None:
+        pending_pick.cancel()
 
 
 class OnlineMedalMixin:
@@ -213,31 +603,57 @@ class OnlineMedalMixin:
     # The percentage of previously labeled data points to include in training
     online_sample_frac = 0.0
 
+    # Previously labeled points are replayed from a bounded memory.
+    # capacity is the max num points it holds, or 0 for no limit.  policy is
+    # "reservoir" (keep a uniform sample) or "ring" (keep the most recent).
+    replay_capacity = 0
+    replay_policy = 'reservoir'
+    # hard cap on num points replayed each al iter.  0 for no limit
+    replay_max_samples = 0
+    # "uniform" or "prioritized" by training loss.  See replay.ReplayMemory
+    replay_sampling = 'uniform'
+    replay_priority_exponent = 1.0
+    replay_priority_staleness_decay = 1.0
+
+    def _get_replay_memory(self):
+        # import here so the command-line starts without torch
+        from .. import replay
+        if getattr(self, '_replay_memory', None) is None:
+            self._replay_memory = replay.ReplayMemory(
+                self.replay_capacity, self.replay_policy,
+                sampling=self.replay_sampling,
+                priority_exponent=self.replay_priority_exponent,
+                staleness_decay=self.replay_priority_staleness_decay)
+            # include points labeled before resuming from a checkpoint
+            self._replay_memory.add(
+                self._train_indices[self._is_labeled].tolist())
+        return self._replay_memory
+
     def update_train_loader(self, points_to_label):
         """This method is called inside the MedAL train loop train.
-        Default settings are to train model using all labeled training data
+        Train on the newly labeled points and a sample of the previously
+        labeled points, drawn from the replay memory.
         """
         if self.online_sample_frac is float:
             raise Exception("Must define online_sample_frac")
 
+        from .. import replay
         # get a subset of the previously labeled points
-        tmp = self._train_indices[self._is_labeled]
-        if int(tmp.shape[0] * self.online_sample_frac) == 0:
-            previously_labeled_points = torch.tensor(
-                [], dtype=torch.long, device=self.device)
-        else:
-            tmpidxs = torch.randperm(
-                tmp.shape[0], device=self.device, dtype=torch.long)[
-                    :int(tmp.shape[0] * self.online_sample_frac)]
-            previously_labeled_points = tmp[tmpidxs]
+        memory = self._get_replay_memory()
+        num_replay = int(memory.num_seen * self.online_sample_frac)
+        if self.replay_max_samples:
+            num_replay = min(num_replay, self.replay_max_samples)
+
         # get the newly labeled points
         _tmp = torch.arange(self._is_labeled.shape[0], device=self.device)
-        newly_labeled_points = _tmp[~self._is_labeled][points_to_label]
+        newly_labeled_points = self._train_indices[
+            _tmp[~self._is_labeled][points_to_label]].tolist()
 
         self._set_points_labeled(points_to_label)
         self.train_loader = feedforward.create_data_loader(
-            self, idxs=torch.cat([
-                previously_labeled_points, newly_labeled_points]).cpu().numpy())
+            self, idxs=None, sampler=replay.ReplaySampler(
+                newly_labeled_points, memory, num_replay))
+        memory.add(newly_labeled_points)
 
 
 class MedalConfigABC(feedforward.FeedForwardModelConfig):
@@ -248,13 +664,59 @@ class MedalConfigABC(feedforward.FeedForwardModelConfig):
     num_points_to_label_per_al_iter = int
     reset_model_weights_each_al_iter = True
 
-    @abc.abstractmethod
-    def get_feature_embedding_layer(self):
-        raise NotImplementedError
+    # keep the model weights between al iters, and train each al iter for an
+    # epoch budget proportional to the fraction of newly labeled points (see
+    # get_warm_start_epochs).  early_stopping_patience scales with the
+    # budget.  The learning rate re-warms up linearly over the first N
+    # batches of each al iter, or set N to 0 to disable.
+    warm_start = False
+    warm_start_min_epochs = 1
+    warm_start_lr_warmup_batches = 0
+
+    # how to pick the most diverse of the num_max_entropy_samples points:
+    # "centroid" picks points far from the labeled centroid (MedAL paper),
+    # "kcenter" uses k-center greedy, optionally on kcenter_num_clusters
+    # minibatch k-means representatives of the candidates (0 to disable)
+    diversity_selection = 'centroid'
+    kcenter_num_clusters = 0
+    # max seconds k-means and k-center greedy may take.  When they run out,
+    # k-means stops early and the remaining points are picked in one step.
+    # 0 for no limit
+    kcenter_time_budget = 0.
+
+    # score the unlabeled pool in N forked cpu processes, each with one
+    # intra-op thread, ie N = the number of cores.  0 or 1 to disable
+    scoring_num_processes = 0
+
+    # pipelined AL: pick the next points to label in a forked cpu process
+    # while training continues.  It scores with a snapshot of the weights,
+    # taken after pipelined_snapshot_frac of the al iter's epochs.  Scoring
+    # runs in N single threaded processes (see scoring_num_processes), and
+    # training gives up N intra-op threads meanwhile.  0 for half of them.
+    pipelined_scoring = False
+    pipelined_snapshot_frac = 0.5
+    pipelined_scoring_num_processes = 0
+
+    # before scoring the unlabeled pool, prefilter it with a cheap proxy: the
+    # model applied to images loaded at proxy_scoring_img_size.  Only
+    # the top proxy_scoring_keep_frac of the pool by proxy entropy is scored
+    # by the full model.  Set img size to 0 to disable.
+    proxy_scoring_img_size = 0
+    proxy_scoring_keep_frac = 0.25
+    log_msg_scoring_time = (
+        "al_iter {config.cur_al_iter} proxy_scoring_time {proxy_scoring_time}"
+        " scoring_time {scoring_time}")
+
+    # embeddings are the output of the model's embedding_layer, average
+    # pooled to N x N.  0 to use the whole feature map, as in the MedAL paper
+    embedding_pool_size = 0
 
     checkpoint_fname = \
         "{config.run_id}/al_{config.cur_al_iter}_epoch_{config.cur_epoch}.pth"
     cur_al_iter = 0  # it's actually 1 indexed
+    log_msg_al_iter = (
+        "al_iter {config.cur_al_iter} "
+        "num_imgs_processed {config._num_imgs_processed}")
 
     def train(self):
         return train(self)
@@ -263,6 +725,8 @@ class MedalConfigABC(feedforward.FeedForwardModelConfig):
         dct = super().get_checkpoint_extra_state()
         for k in ['cur_al_iter', '_is_labeled', '_train_indices']:
             dct[k] = getattr(self, k)
+        if self.warm_start:
+            dct['_al_iter_epochs'] = self._al_iter_epochs
         return dct
 
     def _set_points_labeled(self, points_to_label):
@@ -297,6 +761,8 @@ class MedalConfigABC(feedforward.FeedForwardModelConfig):
 
     def __init__(self, config_override_dict):
         super().__init__(config_override_dict)
+        # num epochs to train in the current al iter
+        self._al_iter_epochs = self.epochs
 
         # override the default feedforward config
         self.log_msg_minibatch = \
@@ -304,16 +770,39 @@ class MedalConfigABC(feedforward.FeedForwardModelConfig):
         self.log_msg_epoch = \
             "al_iter {config.cur_al_iter} " + self.log_msg_epoch
 
-        # split train set into unlabeled and labeled points
-        self._train_indices = torch.tensor(
+    # split train set into unlabeled and labeled points on first access.
+    # The train_loader is recreated appropriately during train.
+    _lazy_attributes = dict(
+        feedforward.FeedForwardModelConfig._lazy_attributes,
+        _train_indices='_get_train_indices',
+        _is_labeled='_get_is_labeled',
+        scoring_model='get_scoring_model',
+        compiled_scoring_model='_get_compiled_scoring_model')
+
+    def _get_train_indices(self):
+        return torch.tensor(
             self.train_loader.sampler.indices.copy(),
             dtype=torch.long, device=self.device)
-        del self.train_loader  # will recreate this appropriately during train
-        self._is_labeled = torch.zeros(
+
+    def _get_is_labeled(self):
+        return torch.zeros(
             self._train_indices.shape, dtype=torch.bool).to(self.device)
 
-        self._serialized_model_state_dict = \
-            pickle.dumps(self.model.state_dict())
+    def get_scoring_model(self):
+        from .. import models
+        # call the model directly, since DataParallel only wraps forward
+        return models.ScoringModel(
+            getattr(self.model, 'module', self.model),
+            self.embedding_pool_size)
+
+    def _get_compiled_scoring_model(self):
+        return self.compile_module(self.scoring_model)
+
+    def get_model(self):
+        model = super().get_model()
+        # keep the initial weights in case we reset the model each al iter
+        self._serialized_model_state_dict = pickle.dumps(model.state_dict())
+        return model
 
 
 class MedalInceptionV3BinaryClassifier(MedalConfigABC,
@@ -323,9 +812,6 @@ class MedalInceptionV3BinaryClassifier(MedalConfigABC,
     num_max_entropy_samples = 20
     num_points_to_label_per_al_iter = 10
 
-    def get_feature_embedding_layer(self):
-        return list(self.model.children())[0][7]
-
 
 class MedalSqueezeNetBinaryClassifier(MedalConfigABC,
                                       BaselineSqueezeNetBinaryClassifier):
@@ -334,9 +820,6 @@ class MedalSqueezeNetBinaryClassifier(MedalConfigABC,
     num_max_entropy_samples = 20
     num_points_to_label_per_al_iter = 10
 
-    def get_feature_embedding_layer(self):
-        return list(self.model.children())[0][0][6]
-
 
 class MedalResnet18BinaryClassifier(MedalConfigABC,
                                     BaselineResnet18BinaryClassifier):
@@ -346,9 +829,6 @@ class MedalResnet18BinaryClassifier(MedalConfigABC,
     num_points_to_label_per_al_iter = 20
     checkpoint_interval = 0  # don't save checkpoints
 
-    def get_feature_embedding_layer(self):
-        return list(self.model.children())[0][5]
-
 
 class OnlineMedalResnet18BinaryClassifier(
         OnlineMedalMixin,
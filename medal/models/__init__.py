@@ -1,3 +1,4 @@
 from .inception import InceptionV3BinaryClassifier
 from .squeezenet import SqueezeNetBinaryClassifier
 from .resnet18 import Resnet18BinaryClassifier
+from .embedding import ScoringModel
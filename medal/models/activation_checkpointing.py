@@ -0,0 +1,51 @@
+"""
+Activation checkpointing of nn.Sequential backbones that contain BatchNorm.
+"""
+from contextlib import contextmanager, nullcontext
+from functools import partial
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+
+@contextmanager
+def preserve_batchnorm_stats(layers):
+    """Restore the running stats of the BatchNorm layers in the given layers
+    when the context exits"""
+    bns = [m for layer in layers for m in layer.modules()
+           if isinstance(m, nn.modules.batchnorm._BatchNorm)
+           and m.track_running_stats]
+    saved = [[buf.clone() for buf in (
+        m.running_mean, m.running_var, m.num_batches_tracked)] for m in bns]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for m, bufs in zip(bns, saved):
+                for buf, _buf in zip((
+                        m.running_mean, m.running_var, m.num_batches_tracked),
+                        bufs):
+                    buf.copy_(_buf)
+
+
+def _recompute_context(layers):
+    return nullcontext(), preserve_batchnorm_stats(layers)
+
+
+def checkpoint_sequential(layers, segments, x):
+    """Like torch.utils.checkpoint.checkpoint_sequential, with non-reentrant
+    checkpoints: split the nn.Sequential layers into segments, keep only the
+    activations at segment boundaries and recompute the rest during backward.
+
+    Unlike it, the recompute doesn't update the BatchNorm running stats a
+    second time, so they match a run without checkpointing.
+    """
+    layers = list(layers.children())
+    segment_size = len(layers) // segments
+    end = 0
+    for start in range(0, segment_size * (segments - 1), segment_size):
+        end = start + segment_size
+        x = checkpoint(
+            nn.Sequential(*layers[start:end]), x, use_reentrant=False,
+            context_fn=partial(_recompute_context, layers[start:end]))
+    return nn.Sequential(*layers[end:])(x)
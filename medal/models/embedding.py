@@ -0,0 +1,45 @@
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def pool_embedding(x, pool_size=0):
+    """Average pool a feature map to pool_size x pool_size and flatten it.
+    If pool_size is 0, flatten the whole feature map"""
+    if pool_size:
+        x = F.adaptive_avg_pool2d(x, pool_size)
+    return x.reshape(x.shape[0], -1)
+
+
+def forward_with_embedding(layers, x, name, pool_size=0):
+    """Apply an nn.Sequential of layers to x.  Return the output and the
+    pooled output of the layer with the given name.  A dotted name like
+    "features.6" names a layer of a nested nn.Sequential.
+
+    Only the pooled embedding is kept, so the full activation of the named
+    layer is freed as soon as the next layer has used it.
+    """
+    head, _, rest = name.partition('.')
+    embedding = None
+    for child_name, layer in layers.named_children():
+        if child_name == head and rest:
+            x, embedding = forward_with_embedding(layer, x, rest, pool_size)
+        else:
+            x = layer(x)
+            if child_name == head:
+                embedding = pool_embedding(x, pool_size)
+    if embedding is None:
+        raise ValueError("No layer named %s" % name)
+    return x, embedding
+
+
+class ScoringModel(nn.Module):
+    """Wrap one of our models so that calling it returns
+    (pooled_embedding, probability), via the model's forward_embedding.
+    Shares parameters with the wrapped model."""
+    def __init__(self, model, pool_size=0):
+        super().__init__()
+        self.model = model
+        self.pool_size = pool_size
+
+    def forward(self, x):
+        return self.model.forward_embedding(x, self.pool_size)
@@ -4,14 +4,29 @@ import torch.nn as nn
 import torchvision as tv
 from collections import OrderedDict
 
+from .activation_checkpointing import checkpoint_sequential
+from .embedding import forward_with_embedding
+
 
 class InceptionV3BinaryClassifier(nn.Module):
     inception_v3_google = \
         'https://download.pytorch.org/models/inception_v3_google-1a9a5a14.pth'
+    # the layer of inception_layers whose output is the MedAL embedding
+    embedding_layer = 'Mixed_5b'
 
     def __init__(self, config):
         super().__init__()
         self.transform_input = True
+        # the transform_input normalization, per channel.  Not saved in the
+        # state dict
+        self.register_buffer('input_scale', torch.tensor(
+            [0.229 / 0.5, 0.224 / 0.5, 0.225 / 0.5]).view(1, 3, 1, 1),
+            persistent=False)
+        self.register_buffer('input_shift', torch.tensor([
+            (0.485 - 0.5) / 0.5, (0.456 - 0.5) / 0.5, (0.406 - 0.5) / 0.5
+        ]).view(1, 3, 1, 1), persistent=False)
+        self.activation_checkpoint_segments = \
+            config.activation_checkpoint_segments
 
         # get layers of baseline model, loaded with some pre-trained weights
         model = tv.models.Inception3(
@@ -43,12 +58,52 @@ class InceptionV3BinaryClassifier(nn.Module):
                 p.requires_grad = is_trainable
 
     def forward(self, x):
-        if self.transform_input:  # copy inception
-            x = x.clone()
-            x[:, 0] = x[:, 0] * (0.229 / 0.5) + (0.485 - 0.5) / 0.5
-            x[:, 1] = x[:, 1] * (0.224 / 0.5) + (0.456 - 0.5) / 0.5
-            x[:, 2] = x[:, 2] * (0.225 / 0.5) + (0.406 - 0.5) / 0.5
-        x = self.inception_layers(x)
-        x = x.mean((2, 3))
-        x = self.top_layers(x)
+        return self.forward_head(self.forward_features(x))
+
+    def forward_features(self, x):
+        """The backbone part of the forward pass"""
+        x = self._transform_input(x)
+        if self.activation_checkpoint_segments and self.training \
+                and torch.is_grad_enabled():
+            # recompute the activations of the backbone during backward
+            x = checkpoint_sequential(
+                self.inception_layers, self.activation_checkpoint_segments, x)
+        else:
+            x = self.inception_layers(x)
+        x = torch.flatten(x, 1)  # avgpool already pooled to 1x1
         return x
+
+    def forward_embedding(self, x, pool_size=0):
+        """Return (pooled_embedding, probability) in one forward pass"""
+        x, embedding = forward_with_embedding(
+            self.inception_layers, self._transform_input(x),
+            self.embedding_layer, pool_size)
+        return embedding, self.forward_head(torch.flatten(x, 1))
+
+    def fold_transform_input(self):
+        """For inference only.  Fold the transform_input normalization into
+        the weights and bias of the first convolution, and disable it.
+        Exact because the first convolution has no padding."""
+        if not self.transform_input:
+            return
+        conv = self.inception_layers.Conv2d_1a_3x3.conv
+        assert conv.padding == (0, 0)
+        with torch.no_grad():
+            W = conv.weight
+            bias = (W * self.input_shift.to(W)).sum((1, 2, 3))
+            if conv.bias is not None:
+                bias += conv.bias
+            conv.bias = nn.Parameter(bias)
+            W.mul_(self.input_scale.to(W))
+        self.transform_input = False
+
+    def _transform_input(self, x):
+        # copy inception, without item assignment, so torch.fx can trace it,
+        # ie for static quantization
+        if self.transform_input:
+            x = x * self.input_scale + self.input_shift
+        return x
+
+    def forward_head(self, x):
+        """The top layers part of the forward pass"""
+        return self.top_layers(x)
@@ -4,13 +4,20 @@ import torch.nn as nn
 import torchvision as tv
 from collections import OrderedDict
 
+from .activation_checkpointing import checkpoint_sequential
+from .embedding import forward_with_embedding
+
 
 class Resnet18BinaryClassifier(nn.Module):
     resnet18 = \
         'https://download.pytorch.org/models/resnet18-5c106cde.pth'
+    # the layer of resnet18_layers whose output is the MedAL embedding
+    embedding_layer = 'layer2'
 
     def __init__(self, config):
         super().__init__()
+        self.activation_checkpoint_segments = \
+            config.activation_checkpoint_segments
         # get layers of baseline model, loaded with some pre-trained weights
         model = tv.models.resnet18()
         if config.load_pretrained_resnet18_weights:
@@ -40,7 +47,26 @@ class Resnet18BinaryClassifier(nn.Module):
                 p.requires_grad = is_trainable
 
     def forward(self, x):
-        x = self.resnet18_layers(x)
+        return self.forward_head(self.forward_features(x))
+
+    def forward_features(self, x):
+        """The backbone part of the forward pass"""
+        if self.activation_checkpoint_segments and self.training \
+                and torch.is_grad_enabled():
+            # recompute the activations of the backbone during backward
+            x = checkpoint_sequential(
+                self.resnet18_layers, self.activation_checkpoint_segments, x)
+        else:
+            x = self.resnet18_layers(x)
         x = x.view(x.size(0), -1)
-        x = self.top_layers(x)
         return x
+
+    def forward_embedding(self, x, pool_size=0):
+        """Return (pooled_embedding, probability) in one forward pass"""
+        x, embedding = forward_with_embedding(
+            self.resnet18_layers, x, self.embedding_layer, pool_size)
+        return embedding, self.forward_head(x.view(x.size(0), -1))
+
+    def forward_head(self, x):
+        """The top layers part of the forward pass"""
+        return self.top_layers(x)
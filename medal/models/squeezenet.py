@@ -4,10 +4,14 @@ import torch.nn as nn
 import torchvision as tv
 from collections import OrderedDict
 
+from .embedding import forward_with_embedding
+
 
 class SqueezeNetBinaryClassifier(nn.Module):
     squeezenet =  \
         'https://download.pytorch.org/models/squeezenet1_0-a815701f.pth'
+    # the layer of squeezenet_layers whose output is the MedAL embedding
+    embedding_layer = 'features.6'
 
     def __init__(self, config):
         super().__init__()
@@ -60,7 +64,20 @@ class SqueezeNetBinaryClassifier(nn.Module):
                 p.requires_grad = is_trainable
 
     def forward(self, x):
-        x = self.squeezenet_layers(x)
+        return self.forward_head(self.forward_features(x))
+
+    def forward_features(self, x):
+        """The backbone part of the forward pass"""
+        return self.squeezenet_layers(x)
+
+    def forward_embedding(self, x, pool_size=0):
+        """Return (pooled_embedding, probability) in one forward pass"""
+        x, embedding = forward_with_embedding(
+            self.squeezenet_layers, x, self.embedding_layer, pool_size)
+        return embedding, self.forward_head(x)
+
+    def forward_head(self, x):
+        """The classifier part of the forward pass"""
         x = self.classifier(x)
         x = x.view(x.size(0), self.num_classes)
         # x = self.top_layers(x)
@@ -0,0 +1,104 @@
+"""
+Stage batches on the device ahead of use, so loading, collating and host to
+device copies overlap with compute.
+"""
+from contextlib import nullcontext
+import queue
+import threading
+import torch
+
+
+def get_memory_format(model):
+    """Return the memory format of the model's convolution weights, ie
+    torch.channels_last if the model was converted with
+    model.to(memory_format=torch.channels_last)"""
+    for p in model.parameters():
+        if p.dim() == 4:
+            if not p.is_contiguous() \
+                    and p.is_contiguous(memory_format=torch.channels_last):
+                return torch.channels_last
+            break
+    return torch.contiguous_format
+
+
+class _Error:
+    def __init__(self, err):
+        self.err = err
+
+
+_END = object()
+
+
+class DevicePrefetcher:
+    """Iterate over the (X, y) batches of a data loader, moved to the device.
+
+    A background thread loads up to num_batches batches ahead of the training
+    or scoring loop and moves them to the device.  4D inputs are converted to
+    the given memory format on the way.  On cuda, copies are non blocking,
+    from pinned memory, on a separate stream.
+    """
+    def __init__(self, batches, device, num_batches=2,
+                 memory_format=torch.contiguous_format):
+        self.batches = batches
+        self.device = torch.device(device)
+        self.num_batches = num_batches
+        self.memory_format = memory_format
+
+    def __len__(self):
+        return len(self.batches)
+
+    def _to_device(self, X, non_blocking):
+        if non_blocking and not X.is_pinned():
+            X = X.pin_memory()
+        if X.dim() == 4:
+            return X.to(self.device, non_blocking=non_blocking,
+                        memory_format=self.memory_format)
+        return X.to(self.device, non_blocking=non_blocking)
+
+    def _load(self, q, stop, stream):
+        cuda = stream is not None
+        try:
+            for X, y in self.batches:
+                with torch.cuda.stream(stream) if cuda else nullcontext():
+                    X = self._to_device(X, non_blocking=cuda)
+                    y = self._to_device(y, non_blocking=cuda)
+                    event = torch.cuda.Event() if cuda else None
+                    if cuda:
+                        event.record(stream)
+                q.put((X, y, event))
+                if stop.is_set():
+                    return
+        except BaseException as err:
+            q.put(_Error(err))
+        q.put(_END)
+
+    def __iter__(self):
+        q = queue.Queue(maxsize=self.num_batches)
+        stop = threading.Event()
+        stream = torch.cuda.Stream(self.device) \
+            if self.device.type == 'cuda' else None
+        thread = threading.Thread(
+            target=self._load, args=(q, stop, stream), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = q.get()
+                if item is _END:
+                    break
+                if isinstance(item, _Error):
+                    raise item.err
+                X, y, event = item
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    X.record_stream(current_stream)
+                    y.record_stream(current_stream)
+                yield X, y
+        finally:
+            # unblock and stop the thread if the loop exited early
+            stop.set()
+            while thread.is_alive():
+                try:
+                    q.get(timeout=.1)
+                except queue.Empty:
+                    pass
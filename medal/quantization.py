@@ -0,0 +1,88 @@
+"""
+Int8 quantized copies of a model for no-grad validation and scoring passes
+on cpu.
+
+"dynamic" quantizes only the weights of nn.Linear layers, and the
+activations on the fly.  "static" quantizes convolutions too, using
+activation ranges observed on a few calibration batches, and is much faster
+for these convolutional models.
+"""
+import copy
+import torch
+import torch.nn as nn
+
+
+def quantize_model(model, mode, calibration_batches):
+    """Return an int8 quantized copy of an eval mode model.  The given model
+    is not modified.
+
+    mode - "dynamic" or "static"
+    calibration_batches - list of preprocessed input batches.  Used by static
+        quantization to observe activation ranges.
+    """
+    model = copy.deepcopy(model).eval()
+    if mode == 'dynamic':
+        return torch.ao.quantization.quantize_dynamic(
+            model, {nn.Linear}, dtype=torch.qint8)
+    elif mode == 'static':
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+        prepared = prepare_fx(
+            model, get_default_qconfig_mapping(
+                torch.backends.quantized.engine),
+            example_inputs=(calibration_batches[0], ))
+        with torch.no_grad():
+            for X in calibration_batches:
+                prepared(X)
+        return convert_fx(prepared)
+    raise ValueError("Unrecognized quantization mode: %s" % mode)
+
+
+def get_calibration_batches(config):
+    """Return up to config.quantization_calibration_batches preprocessed
+    batches of labeled (training) images"""
+    from .model_configs import feedforward
+    batches = []
+    for X, y in config.train_loader:
+        if len(batches) >= config.quantization_calibration_batches:
+            break
+        X = X.to(config.device)
+        batches.append(feedforward.preprocess_batch(config, X, train=False))
+    return batches
+
+
+def _predict(model, X):
+    yhat = model(X)
+    if isinstance(yhat, tuple):  # ie a models.ScoringModel
+        yhat = yhat[1]
+    return yhat.view(-1)
+
+
+def report_quantization_gap(config, float_model, quantized_model, batches):
+    """Print how much the predictions of the quantized model differ from the
+    float model's on the given batches"""
+    from .model_configs.medal import binary_entropy
+    with torch.no_grad():
+        yhat = torch.cat([_predict(float_model, X) for X in batches])
+        yhat_q = torch.cat([_predict(quantized_model, X) for X in batches])
+    print(config.log_msg_quantization_gap.format(
+        num_imgs=yhat.shape[0],
+        prob_gap=(yhat - yhat_q).abs().mean().item(),
+        entropy_gap=(binary_entropy(yhat) - binary_entropy(yhat_q))
+        .abs().mean().item(),
+        pred_agreement=((yhat > .5) == (yhat_q > .5)).float().mean().item(),
+        config=config))
+
+
+def build_quantized_model(config, model):
+    """Quantize the current weights of the given model, which uses the
+    parameters of config.model, for a validation or scoring pass.  Report
+    the gap to the float model on the calibration batches"""
+    was_training = model.training
+    model.eval()
+    batches = get_calibration_batches(config)
+    quantized_model = quantize_model(
+        model, config.quantized_inference, batches)
+    report_quantization_gap(config, model, quantized_model, batches)
+    model.train(was_training)
+    return quantized_model
@@ -0,0 +1,145 @@
+"""
+Replay of previously labeled points for online active learning
+"""
+import numpy as np
+import random
+import torch
+import torch.utils.data as TD
+
+
+class ReplayMemory:
+    """A bounded memory of the dataset indexes of previously labeled points.
+
+    capacity - max number of indexes to keep, or 0 for no limit.
+    policy - which indexes to keep once the memory is full:
+        "reservoir" keeps a uniform random sample of all indexes ever added.
+        "ring" keeps the most recently added indexes.
+    sampling - how to draw indexes to replay:
+        "uniform" draws each index with equal probability.
+        "prioritized" draws each index with probability proportional to
+        priority ** priority_exponent, where the priority is the most recent
+        training loss of that point.  Losses measured k calls to add() ago
+        are shrunk towards the mean loss by a factor staleness_decay ** k.
+        Points with no recorded loss get the max priority.
+
+    Adding n indexes costs O(n) and uniformly sampling k indexes costs O(k),
+    regardless of how many points were ever labeled.  Prioritized sampling
+    costs O(len(memory)).
+
+        >>> memory = ReplayMemory(capacity=1000, policy='reservoir')
+        >>> memory.add([3, 5, 8])
+        >>> memory.sample(2)  # ie [8, 3]
+    """
+    def __init__(self, capacity=0, policy='reservoir', sampling='uniform',
+                 priority_exponent=1.0, staleness_decay=1.0):
+        if policy not in ('reservoir', 'ring'):
+            raise ValueError("Unrecognized replay policy: %s" % policy)
+        if sampling not in ('uniform', 'prioritized'):
+            raise ValueError("Unrecognized replay sampling: %s" % sampling)
+        self.capacity = capacity
+        self.policy = policy
+        self.sampling = sampling
+        self.priority_exponent = priority_exponent
+        self.staleness_decay = staleness_decay
+        self.memory = []
+        self.num_seen = 0  # num indexes ever added
+        self.step = 0  # num calls to add()
+        self.losses = {}  # dataset index: (loss, step when recorded)
+        self._pending_losses = []  # (idxs, losses tensor) not yet in losses
+        self._ring_pos = 0
+
+    def __len__(self):
+        return len(self.memory)
+
+    def add(self, idxs):
+        self.step += 1
+        for idx in idxs:
+            self.num_seen += 1
+            if not self.capacity or len(self.memory) < self.capacity:
+                self.memory.append(idx)
+                continue
+            elif self.policy == 'ring':
+                j = self._ring_pos
+                self._ring_pos = (self._ring_pos + 1) % self.capacity
+            else:
+                j = random.randrange(self.num_seen)
+                if j >= self.capacity:
+                    continue
+            self.losses.pop(self.memory[j], None)
+            self.memory[j] = idx
+
+    def record_losses(self, idxs, losses):
+        """Record the training loss of the given dataset indexes.  losses is
+        a tensor, possibly on the gpu, and is only read on the next sample()
+        to avoid a device sync per batch"""
+        self._pending_losses.append((idxs, losses.detach()))
+
+    def _flush_pending_losses(self):
+        if not self._pending_losses:
+            return
+        idxs = [i for x, _ in self._pending_losses for i in x]
+        losses = torch.cat([x for _, x in self._pending_losses]).tolist()
+        self._pending_losses = []
+        for idx, loss in zip(idxs, losses):
+            self.losses[idx] = (loss, self.step)
+
+    def priorities(self):
+        """Return the sampling probability of each index in self.memory"""
+        self._flush_pending_losses()
+        if not self.memory:
+            return np.ones(0)
+        known = [self.losses[idx] for idx in self.memory if idx in self.losses]
+        if not known:
+            return np.ones(len(self.memory)) / len(self.memory)
+        mean = np.mean([loss for loss, _ in known])
+        max_loss = max(loss for loss, _ in known)
+        p = np.array([
+            mean + (self.losses[idx][0] - mean)
+            * self.staleness_decay ** (self.step - self.losses[idx][1])
+            if idx in self.losses else max_loss
+            for idx in self.memory])
+        p = np.maximum(p, 1e-8) ** self.priority_exponent
+        return p / p.sum()
+
+    def sample(self, n):
+        """Return up to n indexes drawn without replacement"""
+        n = min(n, len(self.memory))
+        if n <= 0:
+            return []
+        if self.sampling == 'uniform':
+            return random.sample(self.memory, n)
+        chosen = np.random.choice(
+            len(self.memory), n, replace=False, p=self.priorities())
+        return [self.memory[i] for i in chosen]
+
+
+class ReplaySampler(TD.Sampler):
+    """Sample newly labeled points together with points replayed from a
+    ReplayMemory.  The replayed points are drawn once, and each pass over
+    the sampler yields all dataset indexes in a new random order.
+
+    If the memory uses prioritized sampling, the training loop should pass
+    the loss of each sample, in the order sampled, to record_losses(...).
+    """
+    def __init__(self, new_idxs, memory, num_replay):
+        self.memory = memory
+        self.indices = np.concatenate([
+            np.asarray(new_idxs, dtype='int64'),
+            np.asarray(memory.sample(num_replay), dtype='int64')])
+        self.tracks_losses = memory.sampling == 'prioritized'
+        self._order = []
+        self._cursor = 0
+
+    def __iter__(self):
+        self._order = np.random.permutation(self.indices).tolist()
+        self._cursor = 0
+        return iter(self._order)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def record_losses(self, losses):
+        """Record the losses of the next len(losses) sampled points"""
+        idxs = self._order[self._cursor:self._cursor + len(losses)]
+        self._cursor += len(losses)
+        self.memory.record_losses(idxs, losses)
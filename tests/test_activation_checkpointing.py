@@ -0,0 +1,26 @@
+import copy
+import types
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('torchvision')
+from medal import models  # noqa: E402
+
+
+def test_checkpointing_updates_batchnorm_stats_once():
+    torch.manual_seed(0)
+    config = types.SimpleNamespace(
+        activation_checkpoint_segments=0,
+        load_pretrained_resnet18_weights=False)
+    model = models.Resnet18BinaryClassifier(config).train()
+    checkpointed = copy.deepcopy(model)
+    checkpointed.activation_checkpoint_segments = 3
+    x = torch.rand(2, 3, 64, 64)
+    for m in (model, checkpointed):
+        m(x).sum().backward()
+    for (name, buf), (_, _buf) in zip(
+            model.named_buffers(), checkpointed.named_buffers()):
+        assert torch.allclose(buf.float(), _buf.float()), name
+    for (name, p), (_, _p) in zip(
+            model.named_parameters(), checkpointed.named_parameters()):
+        assert torch.allclose(p.grad, _p.grad, atol=1e-5), name
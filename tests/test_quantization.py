@@ -0,0 +1,30 @@
+import types
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('torchvision')
+from medal import models  # noqa: E402
+from medal.quantization import quantize_model  # noqa: E402
+
+
+def test_static_quantize_inception():
+    config = types.SimpleNamespace(
+        activation_checkpoint_segments=0,
+        load_pretrained_inception_weights=False)
+    model = models.InceptionV3BinaryClassifier(config).eval()
+    batches = [torch.rand(2, 3, 299, 299)]
+    quantized = quantize_model(model, 'static', batches)
+    yhat = quantized(batches[0])
+    assert yhat.shape == (2, 1)
+    assert model.transform_input  # the given model is not modified
+
+
+def test_static_quantize_inception_scoring_model():
+    config = types.SimpleNamespace(
+        activation_checkpoint_segments=0,
+        load_pretrained_inception_weights=False)
+    model = models.ScoringModel(
+        models.InceptionV3BinaryClassifier(config), pool_size=2).eval()
+    batches = [torch.rand(2, 3, 299, 299)]
+    embedding, yhat = quantize_model(model, 'static', batches)(batches[0])
+    assert embedding.shape[0] == yhat.shape[0] == 2
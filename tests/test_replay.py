@@ -0,0 +1,18 @@
+import pytest
+
+pytest.importorskip('torch')
+from medal.replay import ReplayMemory  # noqa: E402
+
+
+def test_prioritized_sample_empty_memory():
+    memory = ReplayMemory(sampling='prioritized')
+    assert memory.sample(5) == []
+    assert len(memory.priorities()) == 0
+
+
+def test_prioritized_sample_one_item():
+    memory = ReplayMemory(sampling='prioritized')
+    memory.add([7])
+    assert memory.sample(0) == []
+    assert memory.sample(5) == [7]
+    assert memory.priorities().tolist() == [1.0]